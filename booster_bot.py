@@ -3,7 +3,9 @@ from logging import handlers
 import traceback
 import asyncio
 from typing import Union
+import os
 import pickle
+import tempfile
 from datetime import datetime
 
 import discord
@@ -11,11 +13,16 @@ from discord.ext import commands
 from discord.ext.commands.errors import CommandNotFound, MissingRequiredArgument, BadArgument, MissingAnyRole
 
 from helper_functions import *
-from event_objects import Boost, Booster
+from event_objects import Boost, Booster, BoostHandle
 import config
 import db_handling
+import db_async
+import db_stats
+import export
 import constants
 import globals
+import leaderboard
+import journal
 import cogs
 from custom_commands import edit_boost
 
@@ -29,6 +36,8 @@ if config.get('debug', default=False):
     # tester rank
     MNG_RANKS.append(835892359651917834)
 __VERSION__ = config.get('version')
+# !run-sql results bigger than this are uploaded as file instead of messages
+RUN_SQL_INLINE_SIZE = 8000
 
 
 if __name__ == '__main__':
@@ -52,6 +61,15 @@ if __name__ == '__main__':
     client = commands.Bot(command_prefix='!', intents=intents)
 
     globals.init()
+    load_control_emojis()
+
+    def on_config_reload():
+        load_control_emojis()
+        # emoji objects come from discord cache, before ready they are loaded by init_discord_objects
+        if globals.loaded:
+            globals.load_emojis(client)
+
+    config.add_reload_listener(on_config_reload)
 
 # --------------------------------------------------------------------------------------------------------------------------------------------
 
@@ -64,6 +82,8 @@ if __name__ == '__main__':
 
         await client.change_presence(activity=discord.Game(name='!help for commands'))
         if not globals.loaded:
+            await db_async.load_realm_cache()
+            await db_async.load_leaderboards()
             await globals.init_discord_objects(client)
 
 # --------------------------------------------------------------------------------------------------------------------------------------------
@@ -74,7 +94,8 @@ if __name__ == '__main__':
             return
         LOG.debug(f'{ctx.content} {ctx.id}')
 
-        if not ctx.author.bot and not QUIT_CALLED and (ctx.channel.name in config.get('cmd_channels') or (config.get('debug', default=False) and 'testing' in ctx.channel.name)):
+        cfg = config.snapshot()
+        if not ctx.author.bot and not QUIT_CALLED and (ctx.channel.name in cfg.cmd_channels or (cfg.debug and 'testing' in ctx.channel.name)):
             await client.process_commands(ctx)
 
 # --------------------------------------------------------------------------------------------------------------------------------------------
@@ -85,7 +106,7 @@ if __name__ == '__main__':
         global QUIT_CALLED
 
         with open('cache.pickle', 'wb') as f:
-            pickle.dump(({(msg_obj.channel.id, msg_obj.id): boost for uuid, (msg_obj, (boost, _)) in globals.open_boosts.items()}, globals.unprocessed_transactions), f)
+            pickle.dump(({(boost_handle.channel_id, boost_handle.message_id): boost for uuid, (boost_handle, (boost, _)) in globals.open_boosts.items()}, globals.unprocessed_transactions), f)
 
         await ctx.message.channel.send('Leaving...')
         QUIT_CALLED = True
@@ -144,6 +165,8 @@ if __name__ == '__main__':
             raise BadArgument(f'Got too many arguments: {args}.')
 
         results = []
+        entries = []
+        entry_result_idxs = []
         for mention in mentions:
             nick = ctx.guild.get_member(mention2id(mention)).nick
             if nick is None:
@@ -151,26 +174,28 @@ if __name__ == '__main__':
 
             usr = client.get_user(mention2id(mention))
             try:
-                db_handling.add_user(usr.id, parse_nick2realm(nick))
+                home_realm = parse_nick2realm(nick)
             except BadArgument as e:
                 results.append(f':x:{mention}: Transaction with type {transaction_type}, amount {gold_str2int(amount):00} failed: {e}.')
                 continue
-            except:
-                LOG.error(f'Database Error: {traceback.format_exc()}')
-                await ctx.message.author.send(f'Critical error occured, contant administrator.')
-                return
 
-            try:
-                db_handling.add_tranaction(transaction_type, usr.id, ctx.author.id, gold_str2int(amount), ctx.guild.id, comment)
-            except BadArgument as e:
-                results.append(f':x:{mention}: Transaction with type {transaction_type}, amount {gold_str2int(amount)} failed: {e}.')
-                continue
-            except:
-                LOG.error(f'Database Error: {traceback.format_exc()}')
-                await ctx.message.author.send('Critical error occured, contact administrator.')
-                return
+            entries.append((transaction_type, usr.id, home_realm, gold_str2int(amount), comment))
+            entry_result_idxs.append(len(results))
+            results.append(mention)
 
-            results.append(f':white_check_mark:{mention}: Transaction with type {transaction_type}, amount {gold_str2int(amount)} was processed.')
+        try:
+            batch_results = await db_async.add_transactions_batch(entries, ctx.author.id, ctx.guild.id)
+        except:
+            LOG.error(f'Database Error: {traceback.format_exc()}')
+            await ctx.message.author.send('Critical error occured, contact administrator.')
+            return
+
+        for result_idx, (_, processed_amount, error) in zip(entry_result_idxs, batch_results):
+            mention = results[result_idx]
+            if error is not None:
+                results[result_idx] = f':x:{mention}: Transaction with type {transaction_type}, amount {processed_amount} failed: {error}.'
+            else:
+                results[result_idx] = f':white_check_mark:{mention}: Transaction with type {transaction_type}, amount {processed_amount} was processed.'
 
         await send_channel_embed(ctx.message.channel, '\n'.join(results))
 
@@ -178,9 +203,10 @@ if __name__ == '__main__':
 
     @client.command(name='list-transactions', aliases=['lt'])
     @commands.has_any_role(*(BOOSTER_RANKS + MNG_RANKS))
-    async def list_transactions(ctx, limit: int = 10):
+    async def list_transactions(ctx, limit: int = 10, before_id: int = None):
         """
-        Lists your past 10 transactions. Limit of transactions can be overwritten by additional parameter.
+        Lists your past 10 transactions. Limit of transactions can be overwritten by additional parameter, at most 25 are listed per page.
+        Older pages are listed by passing the cursor printed at the end of the previous page.
         """
         LOG.debug(f'{ctx.message.author}: {ctx.message.content}')
         if limit < 1:
@@ -188,7 +214,7 @@ if __name__ == '__main__':
             raise BadArgument(f'{limit} is an invalid value to limit number of transactions!.')
             return
 
-        transactions = db_handling.list_transactions(ctx.message.author.id, limit)
+        transactions, next_cursor = await db_async.list_transactions(ctx.message.author.id, limit, before_id)
 
         transactions_string = ''
         for res_t, author_id in transactions:
@@ -198,15 +224,19 @@ if __name__ == '__main__':
             else:
                 transactions_string += res_t + f' author:{author_id}\n'
 
+        if next_cursor is not None:
+            transactions_string += f'Next page: !lt {limit} {next_cursor}'
+
         await send_channel_embed(ctx.message.channel, transactions_string)
 
 # --------------------------------------------------------------------------------------------------------------------------------------------
 
     @client.command(name='alist-transactions', alaises=['alt'])
     @commands.has_any_role(*MNG_RANKS)
-    async def admin_list_transactions(ctx, mention, limit: int=10):
+    async def admin_list_transactions(ctx, mention, limit: int=10, before_id: int = None):
         """
-        Lists past 10 transactions for specified user. Limit of transactions can be overwritten by additional parameter.
+        Lists past 10 transactions for specified user. Limit of transactions can be overwritten by additional parameter, at most 25 are listed per page.
+        Older pages are listed by passing the cursor printed at the end of the previous page.
         """
         LOG.debug(f'{ctx.message.author}: {ctx.message.content}')
         if limit < 1:
@@ -214,14 +244,60 @@ if __name__ == '__main__':
             raise BadArgument(f'{limit} is an invalid value to limit number of transactions!.')
             return
         usr_id = mention2id(mention)
-        transactions = db_handling.list_transactions(usr_id, limit)
+        transactions, next_cursor = await db_async.list_transactions(usr_id, limit, before_id)
 
-        transactions_string = f'Last {limit} transactions for user: {ctx.guild.get_member(usr_id).name}\n'
+        transactions_string = f'Last {len(transactions)} transactions for user: {ctx.guild.get_member(usr_id).name}\n'
         for res_t, author_id in transactions:
             transactions_string += res_t + f' author:{client.get_user(author_id).name}\n'
 
+        if next_cursor is not None:
+            transactions_string += f'Next page: !alist-transactions {mention} {limit} {next_cursor}'
+
+        await send_channel_embed(ctx.message.channel, transactions_string)
+
+# --------------------------------------------------------------------------------------------------------------------------------------------
+
+    @client.command(name='alist-archive')
+    @commands.has_any_role(*MNG_RANKS)
+    async def admin_list_archive(ctx, mention, limit: int = 10, before_id: int = None):
+        """
+        Lists archived transactions of closed cycles for specified user, paged the same way as !alist-transactions.
+        """
+        LOG.debug(f'{ctx.message.author}: {ctx.message.content}')
+        if limit < 1:
+            raise BadArgument(f'{limit} is an invalid value to limit number of transactions!.')
+        usr_id = mention2id(mention)
+        transactions, next_cursor = await db_async.list_transactions(usr_id, limit, before_id, archived=True)
+
+        transactions_string = f'Archived transactions for user: {mention}\n'
+        for res_t, author_id in transactions:
+            author = client.get_user(author_id)
+            transactions_string += res_t + f' author:{author.name if author is not None else author_id}\n'
+
+        if next_cursor is not None:
+            transactions_string += f'Next page: !alist-archive {mention} {limit} {next_cursor}'
+
         await send_channel_embed(ctx.message.channel, transactions_string)
 
+# --------------------------------------------------------------------------------------------------------------------------------------------
+
+    @client.command(name='boost-ledger', aliases=['bl'])
+    @commands.has_any_role(*MNG_RANKS)
+    async def boost_ledger(ctx, boost_uuid: str):
+        """
+        Expected format: !boost-ledger boost_uuid
+        Lists ledger transactions of a boost, archived ones included.
+        """
+        LOG.debug(f'{ctx.message.author}: {ctx.message.content}')
+        transactions = await db_async.list_boost_transactions(boost_uuid)
+        if not transactions:
+            await ctx.message.channel.send(f'No transactions found for boost {boost_uuid}.')
+            return
+
+        res_str = '\n'.join([f'<@{booster_id}> transaction_type: {type}, amount: {amount}, date_added: {date_added}{" (archived)" if archived else ""}'
+                             for booster_id, type, amount, date_added, archived in transactions])
+        await send_channel_embed(ctx.message.channel, res_str, title=f'Boost {boost_uuid}')
+
 # --------------------------------------------------------------------------------------------------------------------------------------------
 
     @client.command(name='top', aliases=['t'])
@@ -248,7 +324,7 @@ if __name__ == '__main__':
                     if guild_role.name == role:
                         role_objects.append(guild_role)
 
-        top_ppl = db_handling.list_top_boosters(limit, ctx.guild.id)
+        top_ppl = leaderboard.top(ctx.guild.id, limit)
 
         if len(role_objects) == 0:
             res_str = f'Current top {limit} boosters:\n'
@@ -304,7 +380,7 @@ if __name__ == '__main__':
             raise BadArgument(f'{realm_name} is not a known EU realm!')
             return
 
-        top_ppl = db_handling.list_top_boosters(limit, ctx.guild.id, realm_name)
+        top_ppl = leaderboard.top(ctx.guild.id, limit, realm_name)
 
         res_str = f'Current top boosters for realm {realm_name}:\n'
         for idx, data in enumerate(top_ppl):
@@ -319,6 +395,30 @@ if __name__ == '__main__':
         res_str += f'Top total: {sum([x[0] for x in top_ppl])}'
         await send_channel_embed(ctx.message.channel, res_str)
 
+# --------------------------------------------------------------------------------------------------------------------------------------------
+
+    @client.command(name='rank', aliases=['r'])
+    @commands.has_any_role(*(BOOSTER_RANKS + MNG_RANKS))
+    async def rank(ctx):
+        """
+        Lists your current position in guild top and in top of your home realm.
+        """
+        LOG.debug(f'{ctx.message.author}: {ctx.message.content}')
+        user_id = ctx.message.author.id
+
+        guild_rank = leaderboard.rank(ctx.guild.id, user_id)
+        if guild_rank is None:
+            await ctx.message.channel.send(embed=discord.Embed(title='', description=f'{ctx.message.author.mention} has no balance yet.'))
+            return
+
+        res_str = f'Rank for {ctx.message.author.mention}:\n#{guild_rank[0]} in guild with {guild_rank[1]}\n'
+        home_realm = leaderboard.home_realm(user_id)
+        realm_rank = leaderboard.rank(ctx.guild.id, user_id, home_realm)
+        if realm_rank is not None:
+            res_str += f'#{realm_rank[0]} on {home_realm}\n'
+
+        await ctx.message.channel.send(embed=discord.Embed(title='', description=res_str))
+
 # --------------------------------------------------------------------------------------------------------------------------------------------
 
     @client.command('balance', aliases=['b', 'bal'])
@@ -331,7 +431,7 @@ if __name__ == '__main__':
         user_id = ctx.message.author.id
 
         try:
-            balance = db_handling.get_balance(user_id, ctx.guild.id)
+            balance = await db_async.get_balance(user_id, ctx.guild.id)
         except:
             LOG.error(f'Balance command error {traceback.format_exc()}')
             await client.get_user(config.get('my_id')).send(f'Balance command error {traceback.format_exc()}')
@@ -355,7 +455,7 @@ if __name__ == '__main__':
             return
 
         try:
-            balance = db_handling.get_balance(user_id, ctx.guild.id)
+            balance = await db_async.get_balance(user_id, ctx.guild.id)
         except:
             LOG.error(f'Balance command error {traceback.format_exc()}')
             await client.get_user(config.get('my_id')).send(f'Balance command error {traceback.format_exc()}')
@@ -374,7 +474,7 @@ if __name__ == '__main__':
         LOG.debug(f'{ctx.message.author}: {ctx.message.content}')
         realm_name = constants.is_valid_realm(realm_name)
         try:
-            if db_handling.add_alias(realm_name, alias):
+            if await db_async.add_alias(realm_name, alias):
                 await ctx.message.channel.send(f'Added alias "{alias}"="{realm_name}"')
         except db_handling.DatabaseError:
 
@@ -384,7 +484,7 @@ if __name__ == '__main__':
             if msg.content not in ('y', 'n') or msg.content == 'n':
                 return
             else:
-                if db_handling.add_alias(realm_name, alias, update=True):
+                if await db_async.add_alias(realm_name, alias, update=True):
                     await ctx.message.channel.send(f'Overwritten alias "{alias}"="{realm_name}"')
 
 # --------------------------------------------------------------------------------------------------------------------------------------------
@@ -401,7 +501,7 @@ if __name__ == '__main__':
         else:
             id = mention_or_id
 
-        db_handling.remove_user(id)
+        await db_async.remove_user(id)
 
         await ctx.message.channel.send(f'Removed user with id {id}')
 
@@ -425,19 +525,163 @@ if __name__ == '__main__':
 
     @client.command('payout')
     @commands.has_any_role(*MNG_RANKS)
-    async def payout(ctx):
-        results = db_handling.execute_end_cycle(ctx.guild.id, ctx.message.author.id)
-        results_str = '------ END OF CYCLE TRANSACTIONS PROCESSED ------\n'
-        for user_id, result in results:
+    async def payout(ctx, mode: str = None):
+        """
+        Expected format: !payout [preview]
+        Pays out all positive balances and closes the cycle. With preview only lists payouts that would be made.
+        """
+        LOG.debug(f'{ctx.message.author}: {ctx.message.content}')
+        if mode not in (None, 'preview'):
+            raise BadArgument(f'Unknown payout mode "{mode}", only "preview" is accepted.')
+
+        try:
+            # approvals acknowledged before the payout may still wait in journal
+            cycle_id, results = await db_async.run(journal.flush_then, db_handling.execute_end_cycle, ctx.guild.id, ctx.message.author.id, dry_run=mode == 'preview')
+        except db_handling.DatabaseError:
+            LOG.error(f'Payout error {traceback.format_exc()}')
+            await ctx.message.channel.send('End of cycle failed, no payouts were made.')
+            return
+
+        if cycle_id is None:
+            # payout rows as they would be written, one per realm holding
+            results_str = '------ END OF CYCLE PREVIEW ------\n'
+            rows = [(user_id, f'{realm_name or "no realm"} {amount}g') for user_id, realm_name, amount in results]
+        else:
+            results_str = f'------ END OF CYCLE {cycle_id} TRANSACTIONS PROCESSED ------\n'
+            rows = [(user_id, f'{result}g') for user_id, result in results]
+        for user_id, result in rows:
             member = ctx.guild.get_member(user_id)
             member_mention = member.mention if member is not None else user_id
-            if result == 'failed':
-                results_str += f'{member_mention} failed to process\n'
-            else:
-                results_str += f'{member_mention} {result}g\n'
+            results_str += f'{member_mention} {result}\n'
 
         await send_channel_message(ctx.message.channel, results_str)
 
+# --------------------------------------------------------------------------------------------------------------------------------------------
+
+    @client.command('archive-cycle')
+    @commands.has_any_role(*MNG_RANKS)
+    async def archive_cycle(ctx, cycle_id: int = None):
+        """
+        Expected format: !archive-cycle [cycle_id]
+        Moves transactions of closed cycles (latest by default) to archive, leaving one carry forward row per booster realm holding with non-zero net.
+        """
+        LOG.debug(f'{ctx.message.author}: {ctx.message.content}')
+        try:
+            cycle_id, archived_rows, carry_rows = await db_async.archive_cycle(ctx.guild.id, ctx.message.author.id, cycle_id)
+        except db_handling.DatabaseError as e:
+            LOG.error(f'Archive error {traceback.format_exc()}')
+            await ctx.message.channel.send(f'Archiving failed: {str(e).splitlines()[0]}')
+            return
+
+        await ctx.message.channel.send(f'Cycle {cycle_id} archived, {archived_rows} transactions moved to archive, {carry_rows} carried forward.')
+
+# --------------------------------------------------------------------------------------------------------------------------------------------
+
+    @client.command('export')
+    @commands.has_any_role(*MNG_RANKS)
+    async def export_cmd(ctx, *args):
+        """
+        Expected format: !export [csv|jsonl] [since=YYYY-MM-DD] [until=YYYY-MM-DD] [booster=user_mention] [cycle=cycle_id] [archived]
+        Exports transactions of this guild to gzipped file, attached here or saved to export directory when too big.
+        """
+        LOG.debug(f'{ctx.message.author}: {ctx.message.content}')
+        format = 'csv'
+        filters = {}
+        for arg in args:
+            key, _, value = arg.partition('=')
+            try:
+                if arg in export.FORMATS:
+                    format = arg
+                elif arg == 'archived':
+                    filters['archived'] = True
+                elif key in ('since', 'until'):
+                    export.day2timestamp(value)
+                    filters[key] = value
+                elif key == 'booster' and is_mention(value):
+                    filters['booster_id'] = mention2id(value)
+                elif key == 'cycle':
+                    filters['cycle_id'] = int(value)
+                else:
+                    raise ValueError
+            except ValueError:
+                raise BadArgument(f'Unknown export argument "{arg}".')
+
+        export_dir = config.get('export_dir')
+        file_name = f'transactions_{ctx.guild.id}_{datetime.datetime.utcnow():%Y%m%d_%H%M%S}.{format}.gz'
+        path = os.path.join(export_dir or tempfile.gettempdir(), file_name)
+        try:
+            # export may run for export_timeout, on its own thread it doesn't hold a DB worker needed by ledger reads and journal flushes
+            rows = await asyncio.to_thread(export.export_transactions, path, ctx.guild.id, format, **filters)
+        except db_handling.DatabaseError as e:
+            await ctx.channel.send(str(e).splitlines()[0][:2000])
+            return
+
+        try:
+            if os.path.getsize(path) <= ctx.guild.filesize_limit:
+                await ctx.channel.send(f'Exported {rows} transactions.', file=discord.File(path, filename=file_name))
+            elif export_dir:
+                await ctx.channel.send(f'Exported {rows} transactions to {path}, file is too big to attach.')
+            else:
+                await ctx.channel.send(f'Export of {rows} transactions is too big to attach, set export_dir to keep it on disk.')
+        finally:
+            if not export_dir:
+                os.remove(path)
+
+# --------------------------------------------------------------------------------------------------------------------------------------------
+
+    @client.command('realm-holdings', aliases=['rh'])
+    @commands.has_any_role(*MNG_RANKS)
+    async def realm_holdings(ctx, mention: str = None):
+        """
+        Expected format: !realm-holdings [user_mention]
+        Lists gold held on each realm for specified user or for every booster of the guild.
+        """
+        LOG.debug(f'{ctx.message.author}: {ctx.message.content}')
+        if mention is not None and not is_mention(mention):
+            raise BadArgument(f'"{mention}" is not a mention!')
+        booster_id = mention2id(mention) if mention is not None else None
+
+        try:
+            holdings = await db_async.list_realm_holdings(ctx.guild.id, booster_id)
+        except db_handling.DatabaseError:
+            LOG.error(f'Realm holdings error {traceback.format_exc()}')
+            await ctx.message.author.send('Critical error occured, contact administrator.')
+            return
+
+        if not holdings:
+            await ctx.message.channel.send('No gold held on any realm.')
+            return
+
+        res_str = '\n'.join([f'<@{holder_id}> {realm_name or "unknown realm"}: {amount:,d}g' for holder_id, realm_name, amount in holdings])
+        await send_channel_embed(ctx.message.channel, res_str, title='Realm holdings')
+
+# --------------------------------------------------------------------------------------------------------------------------------------------
+
+    @client.command('realm-transfer', aliases=['rtr'])
+    @commands.has_any_role(*MNG_RANKS)
+    async def realm_transfer(ctx, mention: str, amount: str, from_realm: str, to_realm: str, comment: str = None):
+        """
+        Expected format: !realm-transfer user_mention gold_amount from_realm to_realm [comment]
+        Moves gold of user from one realm to another, user balance is unchanged.
+        """
+        LOG.debug(f'{ctx.message.author}: {ctx.message.content}')
+        if not is_mention(mention):
+            raise BadArgument(f'"{mention}" is not a mention!')
+        from_realm = constants.is_valid_realm(from_realm, True)
+        to_realm = constants.is_valid_realm(to_realm, True)
+
+        try:
+            await db_async.transfer_realm_gold(mention2id(mention), ctx.message.author.id, ctx.guild.id, gold_str2int(amount), from_realm, to_realm, comment)
+        except (ValueError, db_handling.InsufficientRealmBalance) as e:
+            await ctx.message.channel.send(f':x:{mention}: Transfer from {from_realm} to {to_realm} failed: {e}')
+            return
+        except db_handling.DatabaseError:
+            LOG.error(f'Realm transfer error {traceback.format_exc()}')
+            await ctx.message.author.send('Critical error occured, contact administrator.')
+            return
+
+        await ctx.message.channel.send(f':white_check_mark:{mention}: Transferred {gold_str2int(amount):,d}g from {from_realm} to {to_realm}.')
+
 # --------------------------------------------------------------------------------------------------------------------------------------------
 
     @client.command('boost')
@@ -584,14 +828,15 @@ if __name__ == '__main__':
         boost_msg = await channel.send(pings_msg, embed=boost_obj.embed())
 
         #async with globals.lock:
-        globals.open_boosts[boost_obj.uuid] = (boost_msg, (boost_obj, asyncio.Lock()))
+        globals.open_boosts.add(BoostHandle.from_message(boost_msg), boost_obj, asyncio.Lock())
         # reactions for controls
         await boost_msg.add_reaction(globals.emojis['tank'])
         await boost_msg.add_reaction(globals.emojis['healer'])
         await boost_msg.add_reaction(globals.emojis['dps'])
-        await boost_msg.add_reaction(config.get('emojis')['keyholder'])
-        await boost_msg.add_reaction(config.get('emojis')['team'])
-        await boost_msg.add_reaction(config.get('emojis')['process'])
+        emojis = config.snapshot().emojis
+        await boost_msg.add_reaction(emojis['keyholder'])
+        await boost_msg.add_reaction(emojis['team'])
+        await boost_msg.add_reaction(emojis['process'])
 
 
 # --------------------------------------------------------------------------------------------------------------------------------------------
@@ -600,13 +845,12 @@ if __name__ == '__main__':
     @commands.has_any_role(*(MNG_RANKS + [707850979059564554]))
     async def edit_cmd(ctx, boost_id: str, timeout: int = 15):
         LOG.debug(f'{ctx.message.author}: {ctx.message.content}')
-        boost_msg, (boost_obj, lock) = globals.open_boosts.get(boost_id, (None, (None, None)))
+        boost_handle, (boost_obj, lock) = globals.open_boosts.get(boost_id, (None, (None, None)))
 
         if boost_obj is not None:
             async with lock:
                 if boost_obj.status != 'closed':
-                    boost_msg = await edit_boost(ctx, boost_obj, boost_msg, boost_id, client, timeout)
-                    globals.open_boosts[boost_id] = boost_msg, (boost_obj, lock)
+                    await edit_boost(ctx, boost_obj, boost_handle, boost_id, client, timeout)
 
     # --------------------------------------------------------------------------------------------------------------------------------------------
 
@@ -614,12 +858,11 @@ if __name__ == '__main__':
     @commands.has_any_role(*MNG_RANKS)
     async def admin_edit_cmd(ctx, boost_id: str, timeout: int = 15):
         LOG.debug(f'{ctx.message.author}: {ctx.message.content}')
-        boost_msg, (boost_obj, lock) = globals.open_boosts.get(boost_id, (None, (None, None)))
+        boost_handle, (boost_obj, lock) = globals.open_boosts.get(boost_id, (None, (None, None)))
 
         if boost_obj is not None:
             async with lock:
-                boost_msg = await edit_boost(ctx, boost_obj, boost_msg, boost_id, client, timeout)
-                globals.open_boosts[boost_id] = boost_msg, (boost_obj, lock)
+                await edit_boost(ctx, boost_obj, boost_handle, boost_id, client, timeout)
 
     # --------------------------------------------------------------------------------------------------------------------------------------------
 
@@ -628,17 +871,16 @@ if __name__ == '__main__':
     async def cancel(ctx, boost_id: str):
         LOG.debug(f'{ctx.message.author}: {ctx.message.content}')
         #async with globals.lock:
-        try:
-            boost_msg, (boost_obj, lock) = globals.open_boosts.get(boost_id, (None, (None, None)))
-        except discord.errors.NotFound:
-            LOG.error('Message with id %s no longer exists (404)', boost_id)
-            globals.open_boosts.pop(boost_id)
-            await ctx.boost_msg.channel.send(f'Boost {boost_id} cancelled, boost message was already deleted.')
-            return
+        boost_handle, (boost_obj, lock) = globals.open_boosts.get(boost_id, (None, (None, None)))
         if boost_obj is not None:
             boost_obj.status = 'closed'
             globals.open_boosts.pop(boost_id)
-            boost_msg = await boost_msg.edit(embed=boost_obj.embed())
+            try:
+                boost_msg = await boost_handle.edit(client, embed=boost_obj.embed())
+            except discord.errors.NotFound:
+                LOG.error('Message with id %s no longer exists (404)', boost_handle.message_id)
+                await ctx.channel.send(f'Boost {boost_id} cancelled, boost message was already deleted.')
+                return
             await boost_msg.channel.send(f'Boost {boost_id} cancelled.', reference=boost_msg)
 
 # --------------------------------------------------------------------------------------------------------------------------------------------
@@ -651,7 +893,7 @@ if __name__ == '__main__':
             await ctx.message.channel.send(f'{booster_mention} is not a mention!')
             return
 
-        boost_msg, (boost_obj, lock) = globals.open_boosts.get(boost_id, (None, (None, None)))
+        boost_handle, (boost_obj, lock) = globals.open_boosts.get(boost_id, (None, (None, None)))
         if boost_obj is not None:
             async with lock:
                 for idx, booster in enumerate(boost_obj.boosters):
@@ -659,8 +901,7 @@ if __name__ == '__main__':
                         boost_obj.boosters.pop(idx)
                         break
 
-                edited_boost_msg = await boost_msg.edit(embed=boost_obj.embed())
-                globals.open_boosts[boost_id] = edited_boost_msg, (boost_obj, lock)
+                await boost_handle.edit(client, embed=boost_obj.embed())
 
 # --------------------------------------------------------------------------------------------------------------------------------------------
 
@@ -684,7 +925,7 @@ if __name__ == '__main__':
         title = msg.embeds[0].to_dict().get('title')
         if title:
             uuid = title.split()[1]
-            globals.unprocessed_transactions[msg_id] = uuid
+            globals.unprocessed_transactions[int(msg_id)] = uuid
 
     # --------------------------------------------------------------------------------------------------------------------------------------------
 
@@ -711,15 +952,130 @@ if __name__ == '__main__':
             LOG.error('Exploit detected: %s', sql)
             return
 
-        res = []
-        conn = db_handling._db_connect()
-        with conn as crs:
-            crs.execute(sql)
+        # result is streamed to disk and never held as a list, real file object is needed by discord.File before python 3.11
+        with tempfile.TemporaryFile() as out:
+            try:
+                rows, truncated = await db_async.stream_select(sql, lambda row: out.write(f'{row}\n'.encode('utf-8')),
+                                                               config.get('run_sql_max_rows', default=10000), config.get('run_sql_timeout', default=10.0))
+            except db_handling.DatabaseError as e:
+                await ctx.channel.send(str(e).splitlines()[0][:2000])
+                return
+
+            summary = f'{rows} rows{" (row limit reached)" if truncated else ""}.'
+            size = out.tell()
+            out.seek(0)
+            if size <= RUN_SQL_INLINE_SIZE:
+                await send_channel_message(ctx.channel, out.read().decode('utf-8') + summary)
+            else:
+                await ctx.channel.send(summary, file=discord.File(out, filename='result.txt'))
+
+# --------------------------------------------------------------------------------------------------------------------------------------------
+
+    @client.command('db-pool-stats')
+    @commands.is_owner()
+    async def db_pool_stats(ctx):
+        """
+        Shows DB connection pool usage.
+        """
+        stats = await db_async.pool_stats()
+        await send_channel_embed(ctx.channel, '\n'.join([f'{key}: {value:.2f}' if isinstance(value, float) else f'{key}: {value}' for key, value in stats.items()]), title='DB pool')
+
+# --------------------------------------------------------------------------------------------------------------------------------------------
+
+    @client.command('db-stats')
+    @commands.is_owner()
+    async def db_stats_cmd(ctx, action: str = None):
+        """
+        Expected format: !db-stats [reset]
+        Shows latency of DB queries per call site, slowest total time first.
+        """
+        if action == 'reset':
+            db_stats.reset()
+            await ctx.channel.send('DB stats reset.')
+            return
+        elif action is not None:
+            raise BadArgument(f'Unknown action "{action}", only "reset" is accepted.')
+
+        cache_stats = db_async.cache_stats()
+        await ctx.channel.send('Read cache: ' + ', '.join([f'{key}: {value}' for key, value in cache_stats.items()]))
+
+        rows = db_stats.snapshot()
+        if not rows:
+            await ctx.channel.send('No queries recorded yet.')
+            return
+
+        lines = [f'{"call site":<32} {"calls":>7} {"errors":>6} {"rows":>8} {"avg ms":>8} {"p50":>7} {"p95":>7} {"max ms":>8}']
+        for tag, calls, errors, row_count, avg_ms, p50_ms, p95_ms, max_ms in rows:
+            lines.append(f'{tag[:32]:<32} {calls:>7} {errors:>6} {row_count:>8} {avg_ms:>8.1f} {p50_ms:>7.1f} {p95_ms:>7.1f} {max_ms:>8.1f}')
+        # code blocks keep the table aligned, one per message chunk
+        for chunk in chunk_message('\n'.join(lines), limit=1990):
+            await ctx.channel.send(f'```{chunk}```')
+
+# --------------------------------------------------------------------------------------------------------------------------------------------
+
+    @client.command('journal')
+    @commands.is_owner()
+    async def journal_cmd(ctx, action: str = None):
+        """
+        Expected format: !journal [requeue]
+        Shows ledger writes waiting in journal and dead letter file, requeue retries dead letter records after their cause was fixed.
+        """
+        if action == 'requeue':
+            requeued = await asyncio.to_thread(journal.requeue_dead)
+            await ctx.channel.send(f'{requeued} dead letter records requeued.')
+            return
+        elif action is not None:
+            raise BadArgument(f'Unknown action "{action}", only "requeue" is accepted.')
+
+        pending = await asyncio.to_thread(journal.pending_count)
+        dead = await asyncio.to_thread(journal.dead_count)
+        await ctx.channel.send(f'Journal: {pending} records pending, {dead} dead letter records.')
 
-            for row in crs:
-                res.append(str(tuple(row)))
+# --------------------------------------------------------------------------------------------------------------------------------------------
 
-        await send_channel_message(ctx.channel, '\n'.join(res))
+    @client.command('reload-config')
+    @commands.is_owner()
+    async def reload_config_cmd(ctx):
+        """
+        Expected format: !reload-config
+        Reloads config.json without restart, invalid file keeps the current config.
+        """
+        try:
+            config.reload()
+        except config.ConfigError as e:
+            await ctx.channel.send(f'Config not reloaded: {e}')
+            return
+
+        LOG.info(f'{ctx.message.author} reloaded config')
+        await ctx.channel.send('Config reloaded.')
+
+# --------------------------------------------------------------------------------------------------------------------------------------------
+
+    @client.command('balances')
+    @commands.is_owner()
+    async def balances(ctx, action: str = 'verify'):
+        """
+        Expected format: !balances verify|rebuild
+        Verifies or recomputes running balances of this guild from transactions.
+        """
+        LOG.debug(f'{ctx.message.author}: {ctx.message.content}')
+        if action == 'verify':
+            mismatches = await db_async.verify_balances(ctx.guild.id)
+            if not mismatches:
+                await ctx.channel.send('Balances are consistent with transactions.')
+                return
+
+            res_str = f'{len(mismatches)} mismatched balances (stored/computed):\n'
+            for _, booster_id, stored, computed in mismatches:
+                res_str += f'{booster_id}: {stored}/{computed}\n'
+            await send_channel_embed(ctx.channel, res_str)
+
+        elif action == 'rebuild':
+            rows = await db_async.rebuild_balances(ctx.guild.id)
+            await ctx.channel.send(f'Balances rebuilt, {rows} rows written.')
+
+        else:
+            raise BadArgument(f'Unknown action "{action}", use verify or rebuild.')
 
 # --------------------------------------------------------------------------------------------------------------------------------------------
 
@@ -801,7 +1157,8 @@ if __name__ == '__main__':
             await after.send(f'You have changed nickname to a bad format, please use <character_name>-<realm_name>. {e}')
             return
 
-        db_handling.add_user(after.id, parse_nick2realm(to_check))
+        # written by UserRegistryCallback, only if home realm actually changed
+        db_handling.queue_user(after.id, parse_nick2realm(to_check))
 
 # --------------------------------------------------------------------------------------------------------------------------------------------
 
@@ -839,6 +1196,11 @@ if __name__ == '__main__':
 
     @client.event
     async def on_raw_reaction_add(payload):
+        # reactions on messages bot doesn't handle are dropped before any API call
+        msg_id = payload.message_id
+        if not is_routed_message(msg_id):
+            return
+
         LOG.debug(payload)
         user = payload.member
         if user is None:
@@ -847,35 +1209,36 @@ if __name__ == '__main__':
             return
 
         emoji = payload.emoji
+        control = classify_emoji(emoji)
+        cfg = config.snapshot()
         LOG.debug('Reaction added by %s', user.nick if user.nick else user.name)
 
-        # tracking logic
-        msg_id = payload.message_id
+        # partial message is enough to remove reactions, whole message is fetched only when its embed is needed
         channel = payload.member.guild.get_channel(payload.channel_id)
-        message = await channel.fetch_message(msg_id)
-
-        if isinstance(channel, discord.DMChannel) and emoji.name == config.get('emojis', 'yes'):
-            registration_channel = payload.member.guild.get_channel(861919086354366474)
-            if registration_channel:
-                LOG.info('Sending registration form from %s', f'{user.name}#{user.discriminator}')
-                await registration_channel.send(f'Registration from {user.name}#{user.discriminator} @ {datetime.datetime.now()}', embed=discord.Embed(title='', description=message.content))
+        message = channel.get_partial_message(msg_id)
 
+        # tracking logic
         if str(msg_id) in globals.tracked_msgs:
             globals.tracked_msgs[str(msg_id)]['added'].append((str(datetime.datetime.utcnow()), user.id, emoji if isinstance(emoji, str) else f'<:{emoji.name}:{emoji.id}>'))
 
         if msg_id in globals.unprocessed_transactions:
             LOG.debug('Transaction reaction: %s', emoji)
-            yes_emoji = config.get('emojis', 'yes')
 
-            if (emoji.name == yes_emoji and user_has_any_role(user.roles, [706853081178046524])) or (config.get('debug', default=False) and user_has_any_role(user.roles, ['Tester'])):
+            if (control is ControlEmoji.YES and user_has_any_role(user.roles, [706853081178046524])) or (cfg.debug and user_has_any_role(user.roles, ['Tester'])):
 
                 # async with globals.lock:
                 # add transactions
+                message = await message.fetch()
                 LOG.debug(message.embeds[0].to_dict())
+                # title is "Boost <uuid>", uuid makes the approval idempotent in ledger
                 comment = message.embeds[0].to_dict()['title'].split()[1]
                 transaction_data = message.embeds[0].to_dict()['fields'][-1]
+                # gold of the run was collected on boost realm
+                boost_realm = next((field['value'] for field in message.embeds[0].to_dict()['fields'] if field['name'] == 'Realm name'), None)
 
                 results = []
+                entries = []
+                entry_result_idxs = []
                 for ln in transaction_data['value'].splitlines():
                     mention, amount = ln.split()
                     amount = amount.split('.')[0]
@@ -892,54 +1255,50 @@ if __name__ == '__main__':
 
                     usr = client.get_user(mention2id(mention))
                     try:
-                        db_handling.add_user(usr.id, parse_nick2realm(nick))
+                        home_realm = parse_nick2realm(nick)
                     except BadArgument as e:
                         LOG.error(f':x:{mention}: Transaction with type add, amount {int(amount)} failed: {e}.')
                         results.append(f':x:{mention}: Transaction with type add, amount {int(amount)} failed: {e}.')
                         continue
-                    except:
-                        LOG.error(f'Database Error: {traceback.format_exc()}')
-                        await user.send(f'Critical error occured, contant administrator.')
-                        return
 
-                    try:
-                        db_handling.add_tranaction('add', usr.id, user.id, int(amount), payload.member.guild.id, comment)
-                    except BadArgument as e:
-                        LOG.error(f':x:{mention}: Transaction with type add, amount {int(amount)} failed: {e}.')
-                        results.append(f':x:{mention}: Transaction with type add, amount {int(amount)} failed: {e}.')
-                        continue
-                    except:
-                        LOG.error(f'Database Error: {traceback.format_exc()}')
-                        await user.send('Critical error occured, contact administrator.')
-                        return
+                    entries.append(('add', usr.id, home_realm, int(amount), comment, boost_realm or home_realm))
+                    entry_result_idxs.append(len(results))
+                    results.append(mention)
+
+                try:
+                    # journaled write returns once durable on disk, JournalCallback writes it to DB
+                    batch_results = await asyncio.to_thread(journal.append, entries, user.id, payload.member.guild.id, comment)
+                except:
+                    LOG.error(f'Database Error: {traceback.format_exc()}')
+                    await user.send('Critical error occured, contact administrator.')
+                    return
 
-                    results.append(f':white_check_mark:{mention}: Transaction with type add, amount {int(amount)} was processed.')
+                for result_idx, (_, processed_amount, error) in zip(entry_result_idxs, batch_results):
+                    mention = results[result_idx]
+                    if error is not None:
+                        LOG.error(f':x:{mention}: Transaction with type add, amount {processed_amount} failed: {error}.')
+                        results[result_idx] = f':x:{mention}: Transaction with type add, amount {processed_amount} failed: {error}.'
+                    else:
+                        results[result_idx] = f':white_check_mark:{mention}: Transaction with type add, amount {processed_amount} was processed.'
 
-                if not config.get('debug', default=False):
-                    attendance_channel = client.get_channel(config.get('channels', 'attendance'))
+                if not cfg.debug:
+                    attendance_channel = client.get_channel(cfg.channels['attendance'])
                     await send_channel_embed(attendance_channel, '\n'.join(results))
                 else:
                     await send_channel_embed(message.channel, '\n'.join(results))
                 globals.unprocessed_transactions.pop(msg_id)
-            elif emoji.name == yes_emoji and not user_has_any_role(user.roles, [706853081178046524]):
+            elif control is ControlEmoji.YES and not user_has_any_role(user.roles, [706853081178046524]):
                 await message.remove_reaction(emoji, user)
 
         boost_uuid = msg_id2boost_uuid(msg_id)
         if boost_uuid is not None:
-            # check if the emoji is one of used
-            id_or_emoji = emoji.id if emoji.id is not None else emoji.name
-            found = False
-            for emoji_name, emoji_id in config.get('emojis').items():
-                if id_or_emoji == emoji_id:
-                    found = True
-                    break
-
-            if not found:
+            if control is None:
                 return
 
-            boost_msg, (boost, lock) = globals.open_boosts[boost_uuid]
+            emoji_name = control.value
+            boost_handle, (boost, lock) = globals.open_boosts[boost_uuid]
             async with lock:
-                if emoji_name == 'team' and boost.team_take is None and user_has_any_role(user.roles, BOOSTER_RANKS) and boost.status == 'open':
+                if control is ControlEmoji.TEAM and boost.team_take is None and user_has_any_role(user.roles, BOOSTER_RANKS) and boost.status == 'open':
                     team_role = None
                     for role in user.roles:
                         if role.color == discord.Color.gold():
@@ -967,12 +1326,11 @@ if __name__ == '__main__':
                         boost.boosters = boosters_to_keep
 
                         LOG.debug(f'{boost_uuid} taken by {team_role.name}!')
-                        edited_boost_msg = await boost_msg.edit(embed=boost.embed())
-                        globals.open_boosts[boost_uuid] = edited_boost_msg, (boost, lock)
+                        edited_boost_msg = await boost_handle.edit(client, embed=boost.embed())
                         await edited_boost_msg.channel.send(team_role.mention)
                         return
 
-                if user_has_any_role(user.roles, BOOSTER_RANKS) and emoji_name in ('dps', 'tank', 'healer', 'keyholder'):
+                if user_has_any_role(user.roles, BOOSTER_RANKS) and control in ROLE_EMOJIS:
                     LOG.debug(f'%s reacted to %s with %s', user.nick if not None else user.name, boost.uuid, emoji_name)
 
                     if boost.team_take is not None and not user_has_any_role(user.roles, [boost.team_take.id]):
@@ -1010,23 +1368,21 @@ if __name__ == '__main__':
 
                     LOG.debug('Adding booster: %s', Booster(mention=user.mention, **{'is_{}'.format(emoji_name): True}))
                     if boost.add_booster(Booster(mention=user.mention, **{'is_{}'.format(emoji_name): True})):
-                        edited_boost_msg = await boost_msg.edit(embed=boost.embed())
-                        globals.open_boosts[boost_uuid] = edited_boost_msg, (boost, lock)
+                        await boost_handle.edit(client, embed=boost.embed())
 
-                if user_has_any_role(user.roles, MNG_RANKS + [707850979059564554]) and emoji_name == 'process':
-                    boost_msg, (boost, _) = globals.open_boosts[boost_uuid]
+                if user_has_any_role(user.roles, MNG_RANKS + [707850979059564554]) and control is ControlEmoji.PROCESS:
                     if boost.status == 'open' or boost.author_dc_id != user.id:
                         return
 
                     embed = boost.process()
                     if embed is not None:
-                        if not config.get('debug', default=False):
-                            post_run_channel = client.get_channel(config.get('channels', 'post-run'))
+                        if not cfg.debug:
+                            post_run_channel = client.get_channel(cfg.channels['post-run'])
                             transaction_msg = await post_run_channel.send(embed=embed)
-                            await transaction_msg.add_reaction(config.get('emojis', 'yes'))
+                            await transaction_msg.add_reaction(cfg.emojis['yes'])
                         else:
-                            transaction_msg = await boost_msg.channel.send(embed=embed)
-                            await transaction_msg.add_reaction(config.get('emojis', 'yes'))
+                            transaction_msg = await boost_handle.partial_message(client).channel.send(embed=embed)
+                            await transaction_msg.add_reaction(cfg.emojis['yes'])
                         # async with globals.lock:
                         globals.unprocessed_transactions[transaction_msg.id] = boost.uuid
 
@@ -1039,7 +1395,13 @@ if __name__ == '__main__':
 
     @client.event
     async def on_raw_reaction_remove(payload):
-        user = await client.get_guild(payload.guild_id).fetch_member(payload.user_id)
+        msg_id = payload.message_id
+        if not is_routed_message(msg_id):
+            return
+
+        # remove payload carries no member, cached one saves the request
+        guild = client.get_guild(payload.guild_id)
+        user = guild.get_member(payload.user_id) or await guild.fetch_member(payload.user_id)
         if user.bot:
             return
 
@@ -1047,34 +1409,39 @@ if __name__ == '__main__':
         LOG.debug('Reaction removed by %s', user.nick if user.nick else user.name)
 
         # tracking logic
-        msg_id = payload.message_id
-        message = await client.get_guild(payload.guild_id).get_channel(payload.channel_id).fetch_message(msg_id)
-
-        msg_id = str(message.id)
-        if msg_id in globals.tracked_msgs:
-            globals.tracked_msgs[msg_id]['removed'].append((str(datetime.datetime.utcnow()), user.id, emoji if isinstance(emoji, str) else f'<:{emoji.name}:{emoji.id}>'))
+        if str(msg_id) in globals.tracked_msgs:
+            globals.tracked_msgs[str(msg_id)]['removed'].append((str(datetime.datetime.utcnow()), user.id, emoji if isinstance(emoji, str) else f'<:{emoji.name}:{emoji.id}>'))
 
-        boost_uuid = msg_id2boost_uuid(message.id)
-        if boost_uuid is not None:
-            # check if the emoji is one of used
-            id_or_emoji = emoji.id if emoji.id is not None else emoji.name
-            for emoji_name, emoji_id in config.get('emojis').items():
-                if id_or_emoji == emoji_id:
-                    break
-
-            if user_has_any_role(user.roles, BOOSTER_RANKS) and emoji_name in ('dps', 'tank', 'healer', 'keyholder'):
-                boost_msg, (boost, lock) = globals.open_boosts[boost_uuid]
+        boost_uuid = msg_id2boost_uuid(msg_id)
+        control = classify_emoji(emoji)
+        if boost_uuid is not None and control in ROLE_EMOJIS:
+            emoji_name = control.value
+            if user_has_any_role(user.roles, BOOSTER_RANKS):
+                boost_handle, (boost, lock) = globals.open_boosts[boost_uuid]
                 async with lock:
                     boost.remove_booster(Booster(mention=user.mention, **{'is_{}'.format(emoji_name): True}))
-                    edited_boost_msg = await boost_msg.edit(embed=boost.embed())
-                    globals.open_boosts[boost_uuid] = edited_boost_msg, (boost, lock)
+                    await boost_handle.edit(client, embed=boost.embed())
 
 # --------------------------------------------------------------------------------------------------------------------------------------------
 
 
 async def post_setup(client):
     await client.add_cog(cogs.BoostCallback(client))
-    await client.start(config.get('token'))
+    await client.add_cog(cogs.JournalCallback(client))
+    await client.add_cog(cogs.UserRegistryCallback(client))
+    await client.add_cog(cogs.ConfigWatcher(client))
+    try:
+        await client.start(config.get('token'))
+    finally:
+        try:
+            await db_async.run(journal.flush)
+        except db_handling.DatabaseError:
+            LOG.error(f'Journal not flushed on shutdown, it will be replayed on next start: {traceback.format_exc()}')
+        try:
+            await db_async.flush_users()
+        except db_handling.DatabaseError:
+            LOG.error(f'Queued users not written on shutdown: {traceback.format_exc()}')
+        db_async.shutdown()
 
 if __name__ == '__main__':
     asyncio.run(post_setup(client))
@@ -9,10 +9,22 @@ from discord.ext import tasks, commands
 import globals
 import booster_bot
 import config
+import db_async
+import db_handling
+import journal
 
 LOG = logging.getLogger(__name__)
 
 
+async def wait_until_loaded(bot):
+    """
+    Waits until on_ready loaded realm cache, leaderboards and discord objects, ledger writes before that would be missed by the boards.
+    """
+    await bot.wait_until_ready()
+    while not globals.loaded:
+        await asyncio.sleep(1)
+
+
 class TrackerCallback(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
@@ -63,22 +75,27 @@ class BoostCallback(commands.Cog):
     async def update_boosts(self):
         #async with globals.lock:
         try:
-            for boost_uuid, (msg, (boost_obj, lock)) in globals.open_boosts.items():
+            # boosts can be untracked while the loop waits for a lock or an edit
+            for boost_uuid, (boost_handle, (boost_obj, lock)) in list(globals.open_boosts.items()):
                 async with lock:
+                    msg = boost_handle.partial_message(self.bot)
                     old_tick = boost_obj.blaster_only_clock
                     should_update = boost_obj.clock_tick()
 
-                    if old_tick != 0 and boost_obj.blaster_only_clock == 0 and boost_obj.status == 'open':
-                        booster = globals.known_roles.get('booster', '')
-                        await msg.channel.send(f'Boost {boost_obj.uuid} now open for {booster.mention}')
-
-                    if should_update:
-                        edited_msg = await msg.edit(embed=boost_obj.embed())
-                        globals.open_boosts[boost_uuid] = edited_msg, (boost_obj, lock)
-                    if boost_obj.start_boost():
-                        edited_msg = await msg.edit(embed=boost_obj.embed())
-                        globals.open_boosts[boost_uuid] = edited_msg, (boost_obj, lock)
-                        await edited_msg.channel.send(f'Boost {boost_obj.uuid} started: ' + ' '.join([b.mention for b in boost_obj.boosters]), reference=edited_msg)
+                    try:
+                        if old_tick != 0 and boost_obj.blaster_only_clock == 0 and boost_obj.status == 'open':
+                            booster = globals.known_roles.get('booster', '')
+                            await msg.channel.send(f'Boost {boost_obj.uuid} now open for {booster.mention}')
+
+                        if should_update:
+                            await msg.edit(embed=boost_obj.embed())
+                        if boost_obj.start_boost():
+                            await msg.edit(embed=boost_obj.embed())
+                            await msg.channel.send(f'Boost {boost_obj.uuid} started: ' + ' '.join([b.mention for b in boost_obj.boosters]), reference=msg)
+                    except discord.errors.NotFound:
+                        # message was deleted, handles restored from cache are not checked on startup
+                        LOG.error(f'Message of boost {boost_uuid} no longer exists (404), dropping boost')
+                        globals.open_boosts.pop(boost_uuid)
         except (RuntimeError, discord.errors.HTTPException):
             LOG.exception('update_boosts exception! ')
             await self.bot.get_user(config.get('my_id')).send(f'Cog exception: {traceback.format_exc()}')
@@ -91,3 +108,82 @@ class BoostCallback(commands.Cog):
     @update_boosts.before_loop
     async def before_update_boosts(self):
         await self.bot.wait_until_ready()
+
+
+class JournalCallback(commands.Cog):
+    """
+    Writes journaled ledger records to DB in batches
+    """
+    def __init__(self, bot):
+        self.bot = bot
+        self.flush_journal.start()
+
+    def cog_unload(self):
+        self.flush_journal.cancel()
+
+    @tasks.loop(seconds=config.get('journal_flush_interval', default=3.0))
+    async def flush_journal(self):
+        dead_lettered = journal.dead_lettered()
+        try:
+            await db_async.run(journal.flush)
+        except db_handling.DatabaseError:
+            # records stay in the journal and are retried on next tick
+            LOG.error(f'Journal flush failed: {traceback.format_exc()}')
+        except Exception:
+            LOG.exception('Unknown exception in flush_journal!')
+
+        if journal.dead_lettered() > dead_lettered:
+            await self.bot.get_user(config.get('my_id')).send(f'{journal.dead_lettered() - dead_lettered} journal records kept failing and were moved to dead letter file, '
+                                                              f'check logs, fix the cause and run !journal requeue.')
+
+    @flush_journal.before_loop
+    async def before_flush_journal(self):
+        await wait_until_loaded(self.bot)
+
+
+class UserRegistryCallback(commands.Cog):
+    """
+    Writes users queued by nickname changes to DB in one batch
+    """
+    def __init__(self, bot):
+        self.bot = bot
+        self.flush_users.start()
+
+    def cog_unload(self):
+        self.flush_users.cancel()
+
+    @tasks.loop(seconds=config.get('user_flush_interval', default=30.0))
+    async def flush_users(self):
+        try:
+            await db_async.flush_users()
+        except db_handling.DatabaseError:
+            # queued users are kept and retried on next tick
+            LOG.error(f'Queued users flush failed: {traceback.format_exc()}')
+        except Exception:
+            LOG.exception('Unknown exception in flush_users!')
+
+    @flush_users.before_loop
+    async def before_flush_users(self):
+        await wait_until_loaded(self.bot)
+
+
+class ConfigWatcher(commands.Cog):
+    """
+    Reloads config when config.json changes
+    """
+    def __init__(self, bot):
+        self.bot = bot
+        self.watch_config.start()
+
+    def cog_unload(self):
+        self.watch_config.cancel()
+
+    @tasks.loop(seconds=config.get('config_watch_interval', default=5.0))
+    async def watch_config(self):
+        try:
+            config.reload_if_changed()
+        except config.ConfigError:
+            # current config stays until the file is fixed
+            LOG.error(f'Config reload failed: {traceback.format_exc()}')
+        except Exception:
+            LOG.exception('Unknown exception in watch_config!')
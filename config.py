@@ -1,12 +1,65 @@
 import json
 import copy
+import logging
+import os
+import types
+from dataclasses import dataclass, field
+from typing import FrozenSet, Mapping, NamedTuple, Union
 
-_CONFIG = {}
+LOG = logging.getLogger(__name__)
+CONFIG_PATH = 'config.json'
+
+
+class ConfigError(Exception):
+    pass
+
+
+class Cut(NamedTuple):
+    adv: float
+    mng: float
+
+
+@dataclass(frozen=True)
+class Snapshot:
+    """
+    Compiled read-only view of config.json, hot paths share it without copying.
+    Readers should take one snapshot per event so they see a consistent config while reload swaps it.
+    """
+    cmd_channels: FrozenSet[str]
+    cuts: Mapping[str, Cut]
+    emojis: Mapping[str, Union[int, str]]
+    channels: Mapping[str, int]
+    debug: bool
+    # parsed file served by get, never handed out without a copy
+    data: dict = field(repr=False)
+
+
+_SNAPSHOT = None
+# (mtime, size) of loaded file
+_STAMP = None
+_RELOAD_LISTENERS = []
+
+
+def _compile(data):
+    return Snapshot(cmd_channels=frozenset(data.get('cmd_channels', ())),
+                    cuts=types.MappingProxyType({name: Cut(cut['adv'], cut['mng']) for name, cut in data.get('cuts', {}).items()}),
+                    emojis=types.MappingProxyType(dict(data.get('emojis', {}))),
+                    channels=types.MappingProxyType(dict(data.get('channels', {}))),
+                    debug=bool(data.get('debug', False)),
+                    data=data)
+
+
+def _stamp():
+    st = os.stat(CONFIG_PATH)
+    return st.st_mtime_ns, st.st_size
+
+
+def snapshot() -> Snapshot:
+    return _SNAPSHOT
 
 
 def get(*keys, default=None):
-    global _CONFIG
-    data = _CONFIG
+    data = _SNAPSHOT.data
     keys = list(keys)
     try:
         while keys:
@@ -20,11 +73,52 @@ def get(*keys, default=None):
         return default
 
 
-def _load_config():
-    global _CONFIG
-    with open('config.json') as f:
-        _CONFIG = copy.deepcopy(json.load(f))
+def add_reload_listener(callback):
+    """
+    Registers callback called without arguments after every reload, e.g. to rebuild lookups compiled from config.
+    """
+    _RELOAD_LISTENERS.append(callback)
+
+
+def reload():
+    """
+    Parses and compiles config file and swaps it in as the current snapshot.
+    Invalid file raises ConfigError and leaves current snapshot in place.
+    """
+    global _SNAPSHOT
+    global _STAMP
+    try:
+        # stamp is taken first so an invalid file is not retried by reload_if_changed until it changes again
+        _STAMP = _stamp()
+        with open(CONFIG_PATH) as f:
+            new_snapshot = _compile(json.load(f))
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        raise ConfigError(f'Invalid {CONFIG_PATH}: {e!r}')
+
+    # single assignment, readers see either the old or the new snapshot
+    _SNAPSHOT = new_snapshot
+    for callback in _RELOAD_LISTENERS:
+        try:
+            callback()
+        except Exception:
+            LOG.exception(f'Config reload listener {callback} failed')
+    return new_snapshot
+
+
+def reload_if_changed():
+    """
+    Reloads config when file changed since last load, returns True if it was reloaded.
+    """
+    try:
+        if _stamp() == _STAMP:
+            return False
+    except OSError as e:
+        raise ConfigError(f'Invalid {CONFIG_PATH}: {e!r}')
+
+    reload()
+    LOG.info(f'Reloaded {CONFIG_PATH}')
+    return True
 
 
-if not _CONFIG:
-    _load_config()
+if _SNAPSHOT is None:
+    reload()
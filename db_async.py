@@ -0,0 +1,154 @@
+import asyncio
+import functools
+import logging
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+import db_handling
+
+LOG = logging.getLogger(__name__)
+
+# bounded number of worker threads, blocking pymysql calls never run on the event loop
+_EXECUTOR = ThreadPoolExecutor(max_workers=config.get('db_workers', default=4), thread_name_prefix='db')
+
+#--------------------------------------------------------------------------------------------------------------------------------------------
+
+async def run(func, *args, **kwargs):
+    """
+    Runs blocking callable in the DB executor and awaits its result.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_EXECUTOR, functools.partial(func, *args, **kwargs))
+
+#--------------------------------------------------------------------------------------------------------------------------------------------
+
+def _offload(func):
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await run(func, *args, **kwargs)
+
+    return wrapper
+
+#--------------------------------------------------------------------------------------------------------------------------------------------
+
+def shutdown(wait=True):
+    _EXECUTOR.shutdown(wait=wait)
+
+#--------------------------------------------------------------------------------------------------------------------------------------------
+
+class ReadCache:
+    """
+    Short lived LRU cache of read results, concurrent identical reads share one DB round trip.
+    Every entry depends on tags, a write touching a tag bumps its generation and entries read under older generation are dropped.
+    Only the event loop reads and fills the cache, invalidate is called from DB worker threads.
+    """
+
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        # key -> (expires, generations, value)
+        self._entries = OrderedDict()
+        # key -> future of the read in progress
+        self._inflight = {}
+        self._generations = defaultdict(int)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def invalidate(self, *tags):
+        with self._lock:
+            for tag in tags:
+                self._generations[tag] += 1
+
+    def _current_generations(self, tags):
+        with self._lock:
+            return tuple(self._generations[tag] for tag in tags)
+
+    async def get(self, key, tags, func, *args, **kwargs):
+        tags = (*tags, ('all',))
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires, generations, value = entry
+            if expires > time.monotonic() and generations == self._current_generations(tags):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._entries[key]
+
+        future = self._inflight.get(key)
+        if future is not None:
+            self.coalesced += 1
+            return await asyncio.shield(future)
+
+        self.misses += 1
+        # taken before the read, write committed meanwhile keeps the result out of cache
+        generations = self._current_generations(tags)
+        future = self._inflight[key] = asyncio.get_running_loop().create_future()
+        try:
+            value = await run(func, *args, **kwargs)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # mark as retrieved, there may be no other waiter
+            future.exception()
+            raise
+        finally:
+            self._inflight.pop(key, None)
+
+        future.set_result(value)
+        if generations == self._current_generations(tags):
+            self._entries[key] = (time.monotonic() + self.ttl, generations, value)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return value
+
+    def stats(self):
+        return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses, 'coalesced': self.coalesced}
+
+
+_CACHE = ReadCache(config.get('read_cache_ttl', default=5.0), config.get('read_cache_size', default=1024))
+db_handling.add_write_listener(_CACHE.invalidate)
+
+#--------------------------------------------------------------------------------------------------------------------------------------------
+
+async def get_balance(discord_id, guild_id):
+    return await _CACHE.get(('get_balance', discord_id, guild_id), [('booster', discord_id)], db_handling.get_balance, discord_id, guild_id)
+
+
+async def list_transactions(user_id, limit, before_id=None, archived=False):
+    return await _CACHE.get(('list_transactions', user_id, limit, before_id, archived), [('booster', user_id)],
+                            db_handling.list_transactions, user_id, limit, before_id, archived)
+
+
+def cache_stats():
+    return _CACHE.stats()
+
+#--------------------------------------------------------------------------------------------------------------------------------------------
+
+# same surface as db_handling, every call has to be awaited
+list_boost_transactions = _offload(db_handling.list_boost_transactions)
+load_leaderboards = _offload(db_handling.load_leaderboards)
+execute_end_cycle = _offload(db_handling.execute_end_cycle)
+archive_cycle = _offload(db_handling.archive_cycle)
+add_tranaction = _offload(db_handling.add_tranaction)
+add_transactions_batch = _offload(db_handling.add_transactions_batch)
+verify_balances = _offload(db_handling.verify_balances)
+rebuild_balances = _offload(db_handling.rebuild_balances)
+get_realm_balance = _offload(db_handling.get_realm_balance)
+list_realm_holdings = _offload(db_handling.list_realm_holdings)
+transfer_realm_gold = _offload(db_handling.transfer_realm_gold)
+load_realm_cache = _offload(db_handling.load_realm_cache)
+add_user = _offload(db_handling.add_user)
+remove_user = _offload(db_handling.remove_user)
+flush_users = _offload(db_handling.flush_users)
+add_alias = _offload(db_handling.add_alias)
+add_realm = _offload(db_handling.add_realm)
+realm_name2id = _offload(db_handling.realm_name2id)
+stream_select = _offload(db_handling.stream_select)
+pool_stats = _offload(db_handling.pool_stats)
@@ -0,0 +1,254 @@
+import contextlib
+import logging
+import pathlib
+import re
+import sqlite3
+import threading
+import time
+
+import pymysql
+import pymysql.cursors
+
+import db_pool
+
+LOG = logging.getLogger(__name__)
+
+
+class Backend:
+    """
+    Storage backend used by db_handling, owns connections and the few SQL dialect differences.
+    Statements are written in pymysql style with %s placeholders.
+    """
+    dialect = None
+    IntegrityError = None
+
+    def cursor(self, read_only=False):
+        """
+        Context manager yielding cursor inside a DB transaction, commits on success and rolls back on any exception.
+        read_only is a promise of the caller that the transaction doesn't write.
+        """
+        raise NotImplementedError
+
+    def begin_snapshot(self, crs):
+        """
+        Turns current transaction into a read only consistent snapshot, has to be called before first query.
+        """
+        raise NotImplementedError
+
+    def read_only_cursor(self, timeout):
+        """
+        Context manager yielding unbuffered cursor on a dedicated read only connection for ad-hoc queries.
+        Rows are fetched from server while iterating, statements running longer than timeout seconds are aborted.
+        """
+        raise NotImplementedError
+
+    def upsert_sql(self, table, columns, keys, assignments):
+        """
+        Returns insert statement which applies assignments on conflict with keys, NEW.<column> refers to the inserted value.
+        """
+        raise NotImplementedError
+
+    def stats(self):
+        return {}
+
+    def close(self):
+        pass
+
+    @staticmethod
+    def _insert_sql(table, columns):
+        return f'insert into `{table}` ({", ".join(f"`{column}`" for column in columns)}) values ({", ".join(["%s"] * len(columns))})'
+
+# --------------------------------------------------------------------------------------------------------------------------------------------
+
+class MySQLBackend(Backend):
+    dialect = 'mysql'
+    IntegrityError = pymysql.IntegrityError
+
+    def __init__(self, connect_kwargs, read_only_kwargs=None, **pool_kwargs):
+        self._pool = db_pool.ConnectionPool(connect_kwargs, **pool_kwargs)
+        # credentials of a user with SELECT privilege only, falls back to the main user
+        self._read_only_kwargs = read_only_kwargs or connect_kwargs
+
+    @contextlib.contextmanager
+    def cursor(self, read_only=False):
+        conn = self._pool.acquire()
+
+        broken = False
+        try:
+            with conn.cursor() as crs:
+                yield crs
+            conn.commit()
+        except:
+            try:
+                conn.rollback()
+            except pymysql.Error:
+                broken = True
+            raise
+        finally:
+            self._pool.release(conn, broken=broken)
+
+    def begin_snapshot(self, crs):
+        crs.execute('start transaction with consistent snapshot, read only')
+
+    @contextlib.contextmanager
+    def read_only_cursor(self, timeout):
+        # not pooled, session settings and an unread result set never leak into ledger connections
+        conn = pymysql.connect(**self._read_only_kwargs)
+        try:
+            crs = conn.cursor(pymysql.cursors.SSCursor)
+            crs.execute('set session max_execution_time=%s', int(timeout * 1000))
+            crs.execute('start transaction read only')
+            yield crs
+        finally:
+            conn.close()
+
+    def upsert_sql(self, table, columns, keys, assignments):
+        return self._insert_sql(table, columns) + ' on duplicate key update ' + re.sub(r'NEW\.(\w+)', r'values(\1)', assignments)
+
+    def stats(self):
+        return self._pool.stats()
+
+    def close(self):
+        self._pool.close()
+
+# --------------------------------------------------------------------------------------------------------------------------------------------
+
+class _SQLiteCursor:
+    """
+    Wraps sqlite3 cursor to accept pymysql style statements and parameters.
+    """
+
+    def __init__(self, crs):
+        self._crs = crs
+
+    @staticmethod
+    def _translate(sql, params):
+        if params is None:
+            return sql, ()
+        if not isinstance(params, (tuple, list, dict)):
+            params = (params,)
+        return sql.replace('%%', '\0').replace('%s', '?').replace('\0', '%'), params
+
+    def execute(self, sql, params=None):
+        sql, params = self._translate(sql, params)
+        self._crs.execute(sql, params)
+        return self._crs.rowcount
+
+    def executemany(self, sql, seq_params):
+        seq_params = list(seq_params)
+        if not seq_params:
+            return 0
+        sql, _ = self._translate(sql, seq_params[0])
+        self._crs.executemany(sql, [params if isinstance(params, (tuple, list, dict)) else (params,) for params in seq_params])
+        return self._crs.rowcount
+
+    def __iter__(self):
+        return iter(self._crs)
+
+    def __getattr__(self, item):
+        return getattr(self._crs, item)
+
+
+class SQLiteBackend(Backend):
+    """
+    Embedded backend, WAL journal lets readers run next to the single writer.
+    """
+    dialect = 'sqlite'
+    IntegrityError = sqlite3.IntegrityError
+
+    def __init__(self, path, timeout=10.0):
+        self.path = path
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._idle = []
+        self._opened = 0
+        self._checkouts = 0
+
+    def _connect(self):
+        # transactions are handled explicitly in cursor()
+        conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None, check_same_thread=False)
+        conn.execute('pragma journal_mode=wal')
+        conn.execute('pragma synchronous=normal')
+        conn.execute('pragma foreign_keys=on')
+        return conn
+
+    def _acquire(self):
+        with self._lock:
+            self._checkouts += 1
+            if self._idle:
+                return self._idle.pop()
+            self._opened += 1
+        return self._connect()
+
+    def _release(self, conn):
+        with self._lock:
+            self._idle.append(conn)
+
+    @contextlib.contextmanager
+    def cursor(self, read_only=False):
+        conn = self._acquire()
+        try:
+            # writers read before they write, deferred transaction would fail upgrading to write lock with SQLITE_BUSY right away,
+            # immediate one takes it upfront and waits for it up to busy timeout
+            conn.execute('begin' if read_only else 'begin immediate')
+            crs = conn.cursor()
+            try:
+                yield _SQLiteCursor(crs)
+            finally:
+                crs.close()
+            conn.execute('commit')
+        except:
+            if conn.in_transaction:
+                conn.execute('rollback')
+            raise
+        finally:
+            self._release(conn)
+
+    def begin_snapshot(self, crs):
+        # deferred transaction in WAL mode already reads from one snapshot and takes no write lock
+        pass
+
+    @contextlib.contextmanager
+    def read_only_cursor(self, timeout):
+        conn = sqlite3.connect(pathlib.Path(self.path).absolute().as_uri() + '?mode=ro', uri=True, timeout=self.timeout, check_same_thread=False)
+        try:
+            conn.execute('pragma query_only=1')
+            deadline = time.monotonic() + timeout
+            # non-zero return interrupts running statement
+            conn.set_progress_handler(lambda: time.monotonic() > deadline, 10000)
+            crs = conn.cursor()
+            try:
+                yield _SQLiteCursor(crs)
+            finally:
+                crs.close()
+        finally:
+            conn.close()
+
+    def upsert_sql(self, table, columns, keys, assignments):
+        return self._insert_sql(table, columns) + f' on conflict ({", ".join(keys)}) do update set ' + re.sub(r'NEW\.(\w+)', r'excluded.\1', assignments)
+
+    def stats(self):
+        with self._lock:
+            return {'path': self.path,
+                    'connections': self._opened,
+                    'idle': len(self._idle),
+                    'checkouts': self._checkouts}
+
+    def close(self):
+        with self._lock:
+            while self._idle:
+                self._idle.pop().close()
+
+# --------------------------------------------------------------------------------------------------------------------------------------------
+
+def create(cfg):
+    """
+    Creates backend from config.json like dict, "db_backend" selects mysql (default) or sqlite.
+    """
+    backend_name = cfg.get('db_backend', 'mysql')
+    if backend_name == 'mysql':
+        return MySQLBackend(cfg['db_creds'], cfg.get('db_readonly_creds'), **cfg.get('db_pool', {}))
+    elif backend_name == 'sqlite':
+        return SQLiteBackend(cfg.get('sqlite_path', 'ledger.db'))
+
+    raise ValueError(f'Unknown db_backend "{backend_name}", use mysql or sqlite.')
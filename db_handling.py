@@ -1,16 +1,79 @@
+import contextlib
 import logging
+import threading
 import traceback
 import typing
 from collections import defaultdict
 
 import discord
-import pymysql
 
 import config
 import constants
+import db_backends
+import db_stats
+import leaderboard
 
 LOG = logging.getLogger(__name__)
 TRANSACTIONS = ('add', 'deduct', 'payout')
+MAX_TRANSACTION_AMOUNT = 2 ** 31 - 1
+TRANSACTIONS_PAGE_SIZE = 25
+# internal transaction type keeping the net of archived cycles in live ledger
+CARRY_FORWARD = 'carry'
+# internal transaction types of gold moved between realms, a transfer is a pair of rows netting to zero
+REALM_TRANSFERS = ('transfer_from', 'transfer_to')
+_TRANSACTION_COLUMNS = '`id`, `type`, `author_id`, `booster_id`, `amount`, `comment`, `guild_id`, `realm_id`, `date_added`, `cycle_id`, `journal_id`, `boost_uuid`'
+
+# SQL of hot ledger queries, migrations.HOT_QUERIES runs EXPLAIN on these same strings
+GET_BALANCE_SQL = 'select amount from balances where booster_id=%s and guild_id=%s'
+# {table} is transactions or transactions_archive
+LIST_TRANSACTIONS_SQL = 'select id, type, amount, date_added, comment, author_id from {table} where booster_id=%s order by id desc limit %s'
+LIST_TRANSACTIONS_PAGE_SQL = 'select id, type, amount, date_added, comment, author_id from {table} where booster_id=%s and id < %s order by id desc limit %s'
+LIST_BOOST_TRANSACTIONS_SQL = ('select booster_id, type, amount, date_added, 0 from transactions where boost_uuid=%s '
+                               'union all select booster_id, type, amount, date_added, 1 from transactions_archive where boost_uuid=%s order by 4')
+# {placeholders} is one %s per journal id, the list is passed twice
+KNOWN_JOURNAL_IDS_SQL = ('select journal_id from transactions where journal_id in ({placeholders}) '
+                         'union all select journal_id from transactions_archive where journal_id in ({placeholders})')
+KNOWN_BOOST_ROWS_SQL = ('select booster_id, type from transactions where boost_uuid=%s '
+                        'union all select booster_id, type from transactions_archive where boost_uuid=%s')
+# (booster_id, realm_id, amount) payout rows of guild, one per realm holding of every booster with positive balance
+PAYOUT_ROWS_SQL = ('select t.booster_id, t.realm_id, -sum(t.amount) as amount from transactions as t '
+                   'join balances as b on (b.guild_id = t.guild_id and b.booster_id = t.booster_id) join users on (b.booster_id = dsc_id) '
+                   'where t.guild_id=%s and b.amount > 0 group by t.guild_id, t.booster_id, t.realm_id having sum(t.amount) != 0')
+PAYOUT_PREVIEW_SQL = f'select p.booster_id, r.name, p.amount from ({PAYOUT_ROWS_SQL}) as p left join realms as r on (p.realm_id = r.id) order by p.booster_id, p.amount'
+PAYOUT_INSERT_SQL = ('insert into transactions (`type`, `author_id`, `booster_id`, `amount`, `comment`, `guild_id`, `cycle_id`, `realm_id`) '
+                     f'select \'payout\', %s, p.booster_id, p.amount, %s, %s, %s, p.realm_id from ({PAYOUT_ROWS_SQL}) as p')
+PAYOUT_BALANCES_SQL = ('update balances set amount = amount + (select sum(t.amount) from transactions as t where t.cycle_id=%s and t.booster_id = balances.booster_id and t.guild_id = balances.guild_id) '
+                       'where guild_id=%s and booster_id in (select booster_id from transactions where cycle_id=%s)')
+CYCLE_PAYOUTS_SQL = 'select booster_id, -sum(amount) from transactions where cycle_id=%s group by booster_id order by sum(amount)'
+ARCHIVE_LAST_ID_SQL = 'select max(id) from transactions where cycle_id=%s'
+ARCHIVE_CARRY_SQL = 'select booster_id, realm_id, sum(amount) as s from transactions where guild_id=%s and id <= %s group by booster_id, realm_id having s != 0'
+ARCHIVE_COPY_SQL = f'insert into transactions_archive ({_TRANSACTION_COLUMNS}, `archive_cycle_id`) select {_TRANSACTION_COLUMNS}, %s from transactions where guild_id=%s and id <= %s'
+ARCHIVE_DELETE_SQL = 'delete from transactions where guild_id=%s and id <= %s'
+GET_REALM_BALANCE_SQL = 'select coalesce(sum(amount), 0) from transactions where booster_id=%s and realm_id=%s'
+GET_GUILD_REALM_BALANCE_SQL = 'select coalesce(sum(amount), 0) from transactions where guild_id=%s and booster_id=%s and realm_id=%s'
+LIST_REALM_HOLDINGS_SQL = ('select t.booster_id, r.name, sum(t.amount) as s from transactions as t left join realms as r on (t.realm_id = r.id) '
+                           'where t.guild_id=%s group by t.booster_id, t.realm_id, r.name having s != 0 order by t.booster_id, s desc')
+LIST_BOOSTER_REALM_HOLDINGS_SQL = ('select t.booster_id, r.name, sum(t.amount) as s from transactions as t left join realms as r on (t.realm_id = r.id) '
+                                   'where t.guild_id=%s and t.booster_id=%s group by t.booster_id, t.realm_id, r.name having s != 0 order by s desc')
+# payout id range of a live cycle
+CYCLE_LAST_ID_SQL = 'select max(id) from transactions where guild_id=%s and cycle_id=%s'
+CYCLE_PREVIOUS_LAST_ID_SQL = 'select coalesce(max(id), 0) from transactions where guild_id=%s and cycle_id < %s'
+# {table} is transactions or transactions_archive, {conditions} starts with guild_id=%s
+STREAM_TRANSACTIONS_SQL = 'select id, type, author_id, booster_id, amount, comment, guild_id, realm_id, date_added, cycle_id from {table} where {conditions} order by id'
+
+_BACKEND = None
+_BACKEND_LOCK = threading.Lock()
+
+# realm name -> realm id and alias -> realm name, loaded by load_realm_cache and kept in sync by add_realm/add_alias
+_REALM_IDS = {}
+_ALIASES = {}
+# dsc_id -> home realm of registered users, loaded by load_leaderboards and kept in sync by user writes, DB is only written on change
+_USERS = {}
+# dsc_id -> home realm waiting for flush_users, nickname changes are debounced here
+_PENDING_USERS = {}
+_PENDING_USERS_LOCK = threading.Lock()
+# callables notified with tags of data changed by a committed write, see add_write_listener
+_WRITE_LISTENERS = []
 
 #--------------------------------------------------------------------------------------------------------------------------------------------
 
@@ -24,179 +87,589 @@ class RealmAlreadyExists(Exception):
     pass
 class UnknownRealmName(Exception):
     pass
+class InsufficientRealmBalance(Exception):
+    pass
 
 #--------------------------------------------------------------------------------------------------------------------------------------------
 
 def get_balance(discord_id, guild_id):
-    ttl = 0
-    with _db_connect() as crs:
-        crs.execute('select amount from transactions as t where booster_id=%s and guild_id=%s', (discord_id, guild_id))
-        for amount, in crs:
-            ttl += amount
+    with _db_cursor(read_only=True) as crs:
+        crs.execute(GET_BALANCE_SQL, (discord_id, guild_id))
+        row = crs.fetchone()
 
-    if not ttl:
+    if not row or not row[0]:
         return 'Total: 0'
     else:
-        return f'Total: {ttl}'
+        return f'Total: {row[0]}'
 
 #--------------------------------------------------------------------------------------------------------------------------------------------
 
-def list_transactions(user_id, limit):
+def list_transactions(user_id, limit, before_id=None, archived=False):
+    """
+    Returns one page of at most TRANSACTIONS_PAGE_SIZE transactions, newest first, older than transaction before_id if set.
+    Archived cycles are listed with archived flag.
+    Returns (res, next_cursor), next_cursor is the before_id for the next page or None on the last page.
+    """
+    limit = min(limit, TRANSACTIONS_PAGE_SIZE)
+    table = 'transactions_archive' if archived else 'transactions'
+    with _db_cursor(read_only=True) as crs:
+        if before_id is None:
+            crs.execute(LIST_TRANSACTIONS_SQL.format(table=table), (user_id, limit + 1))
+        else:
+            crs.execute(LIST_TRANSACTIONS_PAGE_SQL.format(table=table), (user_id, before_id, limit + 1))
+        rows = crs.fetchall()
+
     res = []
-    with _db_connect() as crs:
-        crs.execute('select type, amount, date_added, comment, author_id from transactions where booster_id=%s order by id desc limit {}'.format(limit), user_id)
-        for type, amount, date_added, comment, author_id in crs:
-            res.append((f'transaction_type: {type}, amount:{amount}, date_added: {date_added}, comment: "{comment}"', author_id))
+    for id, type, amount, date_added, comment, author_id in rows[:limit]:
+        res.append((f'transaction_type: {type}, amount:{amount}, date_added: {date_added}, comment: "{comment}"', author_id))
 
-    return res
+    next_cursor = rows[limit - 1][0] if len(rows) > limit else None
+    return res, next_cursor
 
 #--------------------------------------------------------------------------------------------------------------------------------------------
 
-def list_top_boosters(limit, guild_id, realm_name=None):
-    LOG.info(f'Listing top boosters for {realm_name}')
+def list_boost_transactions(boost_uuid):
+    """
+    Returns (booster_id, type, amount, date_added, archived) of every ledger row of boost, archived rows included.
+    """
+    with _db_cursor(read_only=True) as crs:
+        crs.execute(LIST_BOOST_TRANSACTIONS_SQL, (boost_uuid, boost_uuid))
+        return [(booster_id, type, amount, date_added, bool(archived)) for booster_id, type, amount, date_added, archived in crs]
 
-    res = []
-    with _db_connect() as crs:
-        if realm_name is None:
-            crs.execute('select sum(amount) as s, booster_id from transactions where guild_id=%s and booster_id in (select dsc_id from users) group by booster_id having s != 0 order by s desc limit {}'.format(limit), guild_id)
-        else:
-            crs.execute('select sum(amount) as s, booster_id from transactions join users on (booster_id = dsc_id) where home_realm=%s and guild_id=%s and booster_id in (select dsc_id from users) group by booster_id having s != 0 order by s desc limit {}'.format(limit), (realm_name, guild_id))
-        for amount, name in crs:
-            LOG.debug((amount, name))
-            res.append((amount, name))
+#--------------------------------------------------------------------------------------------------------------------------------------------
+
+def execute_end_cycle(guild_id, author_id, dry_run=False):
+    """
+    Pays out every positive balance of active boosters in guild as one set-based INSERT ... SELECT tagged with a new cycle id.
+    Payout is written as one row per realm holding so realm balances are emptied too, a realm in deficit gets a positive row
+    and the rows of a booster always sum up to minus the paid out balance.
+    With dry_run the payout rows that would be written are read by the same query from a consistent snapshot, nothing is locked or written.
+    Returns (cycle_id, [(booster_id, paid out amount), ...]) or (None, [(booster_id, realm_name, row amount), ...]) for dry run.
+    """
+    LOG.info(f'Executing end of cycle for guild {guild_id}, dry run: {dry_run}')
+
+    with _db_cursor(read_only=dry_run) as crs:
+        if dry_run:
+            _backend().begin_snapshot(crs)
+            crs.execute(PAYOUT_PREVIEW_SQL, guild_id)
+            return None, [(booster_id, realm_name, int(amount)) for booster_id, realm_name, amount in crs]
+
+        try:
+            crs.execute('insert into cycles (`guild_id`, `author_id`) values (%s, %s)', (guild_id, author_id))
+            cycle_id = crs.lastrowid
+            # one payout row per realm holding so realm balances are emptied together with the booster balance
+            crs.execute(PAYOUT_INSERT_SQL, (author_id, f'cycle {cycle_id}', guild_id, cycle_id, guild_id))
+            crs.execute(PAYOUT_BALANCES_SQL, (cycle_id, guild_id, cycle_id))
+            crs.execute(CYCLE_PAYOUTS_SQL, cycle_id)
+            # sums are Decimal on MySQL
+            results = [(booster_id, int(amount)) for booster_id, amount in crs]
+        except:
+            raise DatabaseError(f'Failed to execute end of cycle for guild {guild_id}, reason: {traceback.format_exc()}')
+
+    for booster_id, amount in results:
+        leaderboard.apply_delta(guild_id, booster_id, -amount)
+    _notify_write(('guild', guild_id), *[('booster', booster_id) for booster_id, _ in results])
+
+    return cycle_id, results
 
-    return res
-    
 #--------------------------------------------------------------------------------------------------------------------------------------------
 
-def execute_end_cycle(guild_id, author_id):
-    payout = {}
-    results = []
-    with _db_connect() as crs:
-        crs.execute('select sum(amount) as s, booster_id from transactions where guild_id=%s and booster_id in (select dsc_id from users) group by booster_id having s > 0 order by s desc', guild_id)
-        for amount, dsc_id in crs:
-            payout[dsc_id] = amount
+def archive_cycle(guild_id, author_id, cycle_id=None):
+    """
+    Moves every transaction of guild up to the payout of cycle_id (latest unarchived cycle by default) into transactions_archive.
+    Every booster realm holding whose archived rows do not net to zero gets a single carry forward row, balances are unchanged.
+    Returns (cycle_id, number of archived rows, number of carry forward rows).
+    """
+    LOG.info(f'Archiving cycle {cycle_id} of guild {guild_id}')
+
+    with _db_cursor() as crs:
+        if cycle_id is None:
+            crs.execute('select max(id) from cycles where guild_id=%s and archived=0', guild_id)
+            cycle_id, = crs.fetchone()
+            if cycle_id is None:
+                raise DatabaseError(f'No unarchived cycle found for guild {guild_id}.')
+        else:
+            crs.execute('select archived from cycles where id=%s and guild_id=%s', (cycle_id, guild_id))
+            row = crs.fetchone()
+            if row is None:
+                raise DatabaseError(f'Cycle {cycle_id} not found for guild {guild_id}.')
+            if row[0]:
+                raise DatabaseError(f'Cycle {cycle_id} is already archived.')
 
-        for booster_id, amount in payout.items():
-            try:
-                add_tranaction('payout', booster_id, author_id, amount, guild_id)
-                results.append((booster_id, amount))
-            except DatabaseError as e:
-                LOG.error('Payout exception %s', e)
-                results.append((booster_id, 'failed'))
+        try:
+            crs.execute(ARCHIVE_LAST_ID_SQL, cycle_id)
+            last_id, = crs.fetchone()
+            archived_rows = 0
+            carry_rows = []
+            if last_id is not None:
+                crs.execute(ARCHIVE_CARRY_SQL, (guild_id, last_id))
+                carry_rows = [(CARRY_FORWARD, author_id, booster_id, amount, f'carry forward from cycle {cycle_id}', guild_id, realm_id) for booster_id, realm_id, amount in crs]
+
+                crs.execute(ARCHIVE_COPY_SQL, (cycle_id, guild_id, last_id))
+                archived_rows = crs.execute(ARCHIVE_DELETE_SQL, (guild_id, last_id))
+                crs.executemany('insert into transactions (`type`, `author_id`, `booster_id`, `amount`, `comment`, `guild_id`, `realm_id`) values (%s, %s, %s, %s, %s, %s, %s)', carry_rows)
+
+            # earlier cycles have no rows left in live ledger either
+            crs.execute('update cycles set archived=1 where guild_id=%s and id <= %s', (guild_id, cycle_id))
+        except:
+            raise DatabaseError(f'Failed to archive cycle {cycle_id} of guild {guild_id}, reason: {traceback.format_exc()}')
 
-    return results
+    # transaction history of every booster of guild changed
+    _notify_write(('all',))
+    return cycle_id, archived_rows, len(carry_rows)
 
 #--------------------------------------------------------------------------------------------------------------------------------------------
 
-def add_tranaction(type, booster_id, transaction_author_id, amount, guild_id, comment=None):
+def add_tranaction(type, booster_id, transaction_author_id, amount, guild_id, comment=None, realm_name=None):
     if type in ('deduct', 'payout'):
         amount  = -amount
+    realm_id = realm_name2id(realm_name)
 
-    with _db_connect() as crs:
+    with _db_cursor() as crs:
         try:
-            crs.execute('insert into transactions (`type`, `author_id`, `booster_id`, `amount`, `comment`, `guild_id`) values (%s, %s, %s, %s, %s, %s)', (type, transaction_author_id, booster_id, amount, comment, guild_id))
+            crs.execute('insert into transactions (`type`, `author_id`, `booster_id`, `amount`, `comment`, `guild_id`, `realm_id`) values (%s, %s, %s, %s, %s, %s, %s)',
+                        (type, transaction_author_id, booster_id, amount, comment, guild_id, realm_id))
+            # running balance is kept in the same DB transaction as the ledger row
+            crs.execute(_backend().upsert_sql('balances', ('guild_id', 'booster_id', 'amount'), ('guild_id', 'booster_id'), 'amount=amount + NEW.amount'), (guild_id, booster_id, amount))
         except:
             raise DatabaseError(f'Failed to add transaction with parameters {type} {booster_id} {amount} {comment}, reason: {traceback.format_exc()}')
 
+    leaderboard.apply_delta(guild_id, booster_id, amount)
+    _notify_write(('booster', booster_id), ('guild', guild_id))
+
 #--------------------------------------------------------------------------------------------------------------------------------------------
 
-def get_realm_balance(realm_name, dsc_id):
-    realm_id = realm_name2id(realm_name)
-    all_transactions = []
-    with _db_connect() as crs:
+def validate_transaction(type, amount):
+    """
+    Returns reason why transaction can't be processed or None for valid transaction.
+    """
+    if type not in TRANSACTIONS:
+        return f'Unknown transaction type {type}'
+    if not 0 <= amount <= MAX_TRANSACTION_AMOUNT:
+        return f'Only amounts between 0 and {MAX_TRANSACTION_AMOUNT} are accepted'
+    return None
+
+#--------------------------------------------------------------------------------------------------------------------------------------------
+
+def add_transactions_batch(entries, transaction_author_id, guild_id, journal_ids=None, boost_uuid=None, check_journal_ids=True):
+    """
+    Processes list of (type, booster_id, home_realm, amount, comment[, realm_name[, date_added]]) entries in a single DB transaction.
+    Gold is booked on realm_name, home realm of the booster when omitted.
+    date_added is 'YYYY-MM-DD HH:MM:SS' timestamp of historic entries, entries without it are dated now by the DB.
+    Users are upserted and transactions with balances are written with multi-row statements, any DB error rolls back the whole batch.
+    Optional journal_ids pair every entry with a unique id, entries already present in ledger are skipped so journal replays are no-ops.
+    check_journal_ids=False skips looking them up for ids that are most likely new, live duplicate still fails the unique index and the batch is retried with the lookup.
+    With boost_uuid the batch is payout of that boost, ledger holds one row per booster and type of a boost so approving it again is a no-op.
+    Returns list of (booster_id, amount, error) in the order of entries, error is None for processed entries.
+    """
+    if journal_ids is None:
+        journal_ids = [None] * len(entries)
+
+    results = []
+    valid_entries = []
+    for entry, journal_id in zip(entries, journal_ids):
+        type, booster_id, home_realm, amount, comment = entry[:5]
+        realm_name = entry[5] if len(entry) > 5 else home_realm
+        date_added = entry[6] if len(entry) > 6 else None
+        error = validate_transaction(type, amount)
+        if error is None:
+            # realms are resolved before taking a cursor, new realm is inserted by its own DB transaction
+            try:
+                realm_id = realm_name2id(realm_name)
+            except UnknownRealmName:
+                LOG.warning(f'Booking transaction of {booster_id} without realm, "{realm_name}" is not a known EU realm')
+                realm_id = None
+            valid_entries.append((len(results), type, booster_id, home_realm, amount, comment, journal_id, realm_id, date_added))
+        results.append((booster_id, amount, error))
+
+    if not valid_entries:
+        return results
+
+    for attempt in range(2):
         try:
-            crs.execute('select type, amount from transactions where booster_id=%s and realm_id=%s', (dsc_id, realm_id))
-            for tt, amount in crs:
-                all_transactions.append((tt, amount))
+            users, balance_deltas = _write_transactions_batch(valid_entries, results, transaction_author_id, guild_id, boost_uuid, check_journal_ids or attempt > 0)
+            break
+        except _backend().IntegrityError:
+            # concurrent approval of the same boost or unchecked journal id committed first, second attempt skips its rows
+            if attempt:
+                raise DatabaseError(f'Failed to add transaction batch {entries}, reason: {traceback.format_exc()}')
+            LOG.warning(f'Retrying transaction batch of boost {boost_uuid} after conflict')
+
+    for booster_id, home_realm in users.items():
+        _USERS[booster_id] = home_realm
+        leaderboard.set_home_realm(booster_id, home_realm)
+    for booster_id, delta in balance_deltas.items():
+        leaderboard.apply_delta(guild_id, booster_id, delta)
+    if balance_deltas:
+        _notify_write(('guild', guild_id), *[('booster', booster_id) for booster_id in balance_deltas], *([('users',)] if users else []))
+
+    return results
+
+
+def _write_transactions_batch(valid_entries, results, transaction_author_id, guild_id, boost_uuid, check_journal_ids):
+    users = {}
+    transaction_rows = []
+    # (booster_id, type) -> index of its row, entries of the same booster in one boost are merged to keep boost rows unique
+    boost_rows = {}
+    balance_deltas = defaultdict(int)
+    with _db_cursor() as crs:
+        try:
+            known_journal_ids = set()
+            batch_journal_ids = [journal_id for *_, journal_id, _, _ in valid_entries if journal_id is not None] if check_journal_ids else []
+            # archived cycles are checked too, approval replayed after archive_cycle must not pay again
+            if batch_journal_ids:
+                crs.execute(KNOWN_JOURNAL_IDS_SQL.format(placeholders=', '.join(['%s'] * len(batch_journal_ids))), batch_journal_ids * 2)
+                known_journal_ids = {journal_id for journal_id, in crs}
+
+            known_boost_rows = set()
+            if boost_uuid is not None:
+                crs.execute(KNOWN_BOOST_ROWS_SQL, (boost_uuid, boost_uuid))
+                known_boost_rows = set(crs.fetchall())
+
+            for result_idx, type, booster_id, home_realm, amount, comment, journal_id, realm_id, date_added in valid_entries:
+                if journal_id in known_journal_ids or (booster_id, type) in known_boost_rows:
+                    results[result_idx] = (booster_id, amount, 'Already processed')
+                    continue
+
+                signed_amount = -amount if type in ('deduct', 'payout') else amount
+                if booster_id not in _USERS or _USERS[booster_id] != home_realm:
+                    users[booster_id] = home_realm
+                balance_deltas[booster_id] += signed_amount
+
+                row_idx = boost_rows.get((booster_id, type)) if boost_uuid is not None else None
+                if row_idx is not None:
+                    row = transaction_rows[row_idx]
+                    transaction_rows[row_idx] = (*row[:3], row[3] + signed_amount, *row[4:])
+                    continue
+                boost_rows[(booster_id, type)] = len(transaction_rows)
+                transaction_rows.append((type, transaction_author_id, booster_id, signed_amount, comment, guild_id, journal_id, realm_id, boost_uuid, date_added))
+
+            if transaction_rows:
+                LOG.info(f'Adding batch of {len(transaction_rows)} transactions for guild {guild_id}')
+                if users:
+                    crs.executemany(_backend().upsert_sql('users', ('dsc_id', 'home_realm'), ('dsc_id',), 'home_realm=NEW.home_realm'), list(users.items()))
+                columns = '`type`, `author_id`, `booster_id`, `amount`, `comment`, `guild_id`, `journal_id`, `realm_id`, `boost_uuid`'
+                # dated rows get their own statement, undated ones keep the DB default of date_added
+                undated_rows = [row[:-1] for row in transaction_rows if row[-1] is None]
+                dated_rows = [row for row in transaction_rows if row[-1] is not None]
+                if undated_rows:
+                    crs.executemany(f'insert into transactions ({columns}) values ({", ".join(["%s"] * 9)})', undated_rows)
+                if dated_rows:
+                    crs.executemany(f'insert into transactions ({columns}, `date_added`) values ({", ".join(["%s"] * 10)})', dated_rows)
+                crs.executemany(_backend().upsert_sql('balances', ('guild_id', 'booster_id', 'amount'), ('guild_id', 'booster_id'), 'amount=amount + NEW.amount'),
+                                [(guild_id, booster_id, delta) for booster_id, delta in balance_deltas.items()])
+        except _backend().IntegrityError:
+            raise
         except:
-            raise DatabaseError(f'Failed to get all transactions for user with id {dsc_id} on realm {realm_name}.')
+            raise DatabaseError(f'Failed to add transaction batch, reason: {traceback.format_exc()}')
+
+    return users, balance_deltas
+
+#--------------------------------------------------------------------------------------------------------------------------------------------
+
+def verify_balances(guild_id=None):
+    """
+    Compares balances table with sums recomputed from transactions.
+    Returns list of (guild_id, booster_id, stored_amount, computed_amount) for every mismatch.
+    """
+    stored = {}
+    computed = {}
+    with _db_cursor(read_only=True) as crs:
+        if guild_id is None:
+            crs.execute('select guild_id, booster_id, amount from balances')
+        else:
+            crs.execute('select guild_id, booster_id, amount from balances where guild_id=%s', guild_id)
+        for g_id, booster_id, amount in crs:
+            stored[(g_id, booster_id)] = amount
+
+        if guild_id is None:
+            crs.execute('select guild_id, booster_id, sum(amount) from transactions group by guild_id, booster_id')
+        else:
+            crs.execute('select guild_id, booster_id, sum(amount) from transactions where guild_id=%s group by guild_id, booster_id', guild_id)
+        for g_id, booster_id, amount in crs:
+            computed[(g_id, booster_id)] = amount
 
-        ttl = 0
-        for tt, amount in all_transactions:
-            if tt in ('transfer_to', 'add'):
-                ttl += amount
-            elif tt in ('transfer_from', 'deduct'):
-                ttl -= amount
+    mismatches = []
+    for key in set(stored) | set(computed):
+        if stored.get(key, 0) != computed.get(key, 0):
+            mismatches.append((*key, stored.get(key), computed.get(key)))
 
-        return amount
+    return mismatches
 
 #--------------------------------------------------------------------------------------------------------------------------------------------
 
-def alias2realm(alias):
-    LOG.info(f'Getting alias for {alias}')
+def rebuild_balances(guild_id=None):
+    """
+    Recomputes balances table from transactions in a single DB transaction, returns number of balance rows written.
+    """
+    LOG.info(f'Rebuilding balances for guild {guild_id}')
+
+    with _db_cursor() as crs:
+        try:
+            if guild_id is None:
+                crs.execute('delete from balances')
+                rows = crs.execute('insert into balances (`guild_id`, `booster_id`, `amount`) select guild_id, booster_id, sum(amount) from transactions group by guild_id, booster_id')
+            else:
+                crs.execute('delete from balances where guild_id=%s', guild_id)
+                rows = crs.execute('insert into balances (`guild_id`, `booster_id`, `amount`) select guild_id, booster_id, sum(amount) from transactions where guild_id=%s group by guild_id, booster_id', guild_id)
+        except:
+            raise DatabaseError(f'Failed to rebuild balances for guild {guild_id}: {traceback.format_exc()}')
+
+    load_leaderboards()
+    _notify_write(('all',))
+    return rows
+
+#--------------------------------------------------------------------------------------------------------------------------------------------
 
-    with _db_connect() as crs:
-        ret = crs.execute('select realm_name from aliases where alias=%s', alias)
-        if ret == 0:
-            return alias
+def load_leaderboards():
+    """
+    Seeds leaderboards and the user registry.
+    """
+    global _USERS
+
+    with _db_cursor(read_only=True) as crs:
+        crs.execute('select guild_id, booster_id, amount from balances where amount != 0')
+        balance_rows = list(crs)
+        crs.execute('select dsc_id, home_realm from users')
+        user_rows = list(crs)
+
+    _USERS = dict(user_rows)
+    leaderboard.seed(balance_rows, user_rows)
+
+#--------------------------------------------------------------------------------------------------------------------------------------------
+
+def get_realm_balance(realm_name, dsc_id, guild_id=None):
+    """
+    Returns gold of booster held on realm, in all guilds unless guild_id is set.
+    """
+    realm_id = _REALM_IDS.get(realm_name)
+    if realm_id is None:
+        # realm may have been added by another process since the cache was loaded
+        realm_id = _select_realm_id(realm_name)
+        if realm_id is None:
+            return 0
+        _REALM_IDS[realm_name] = realm_id
+
+    with _db_cursor(read_only=True) as crs:
+        try:
+            if guild_id is None:
+                crs.execute(GET_REALM_BALANCE_SQL, (dsc_id, realm_id))
+            else:
+                crs.execute(GET_GUILD_REALM_BALANCE_SQL, (guild_id, dsc_id, realm_id))
+            amount, = crs.fetchone()
+        except:
+            raise DatabaseError(f'Failed to get realm balance for user with id {dsc_id} on realm {realm_name}: {traceback.format_exc()}')
+
+    # sum is Decimal on MySQL
+    return int(amount)
+
+#--------------------------------------------------------------------------------------------------------------------------------------------
+
+def list_realm_holdings(guild_id, booster_id=None):
+    """
+    Returns non-zero (booster_id, realm_name, amount) holdings of guild or of a single booster, aggregated by one grouped query.
+    Realm name is None for legacy transactions recorded without realm.
+    """
+    with _db_cursor(read_only=True) as crs:
+        if booster_id is None:
+            crs.execute(LIST_REALM_HOLDINGS_SQL, guild_id)
         else:
-            return crs.fetchone()[0]
+            crs.execute(LIST_BOOSTER_REALM_HOLDINGS_SQL, (guild_id, booster_id))
+        # sums are Decimal on MySQL
+        return [(booster_id, realm_name, int(amount)) for booster_id, realm_name, amount in crs]
+
+#--------------------------------------------------------------------------------------------------------------------------------------------
+
+def transfer_realm_gold(booster_id, transaction_author_id, guild_id, amount, from_realm, to_realm, comment=None):
+    """
+    Moves amount of booster gold from one realm to another as a transfer_from/transfer_to pair, booster balance is unchanged.
+    Raises InsufficientRealmBalance when from_realm holds less than amount, concurrent transfers of a booster are serialized by lock of the booster's balance row.
+    """
+    error = validate_transaction('add', amount)
+    if error is not None:
+        raise ValueError(error)
+    if from_realm == to_realm:
+        raise ValueError('Source and target realm are the same.')
+
+    from_realm_id = realm_name2id(from_realm)
+    to_realm_id = realm_name2id(to_realm)
+    LOG.info(f'Transferring {amount} of {booster_id} from {from_realm} to {to_realm}')
+
+    with _db_cursor() as crs:
+        try:
+            # locking read comes first so the snapshot of the sum below is taken after a concurrent transfer committed,
+            # SQLite ledger transaction holds the database write lock already
+            if dialect() == 'mysql':
+                crs.execute('select amount from balances where guild_id=%s and booster_id=%s for update', (guild_id, booster_id))
+                crs.fetchall()
+            crs.execute('select coalesce(sum(amount), 0) from transactions where guild_id=%s and booster_id=%s and realm_id=%s', (guild_id, booster_id, from_realm_id))
+            held, = crs.fetchone()
+        except:
+            raise DatabaseError(f'Failed to get realm balance for user with id {booster_id} on realm {from_realm}: {traceback.format_exc()}')
+        if held < amount:
+            raise InsufficientRealmBalance(f'Only {held} held on {from_realm}.')
+
+        try:
+            crs.executemany('insert into transactions (`type`, `author_id`, `booster_id`, `amount`, `comment`, `guild_id`, `realm_id`) values (%s, %s, %s, %s, %s, %s, %s)',
+                            [(REALM_TRANSFERS[0], transaction_author_id, booster_id, -amount, comment, guild_id, from_realm_id),
+                             (REALM_TRANSFERS[1], transaction_author_id, booster_id, amount, comment, guild_id, to_realm_id)])
+        except:
+            raise DatabaseError(f'Failed to transfer {amount} of user with id {booster_id} from {from_realm} to {to_realm}: {traceback.format_exc()}')
+
+    _notify_write(('booster', booster_id), ('guild', guild_id))
+
+#--------------------------------------------------------------------------------------------------------------------------------------------
+
+def load_realm_cache():
+    global _REALM_IDS
+    global _ALIASES
+
+    with _db_cursor(read_only=True) as crs:
+        crs.execute('select name, id from realms')
+        realm_ids = {name: id for name, id in crs}
+        crs.execute('select alias, realm_name from aliases')
+        aliases = {alias: realm_name for alias, realm_name in crs}
+
+    _REALM_IDS, _ALIASES = realm_ids, aliases
+    LOG.info(f'Loaded {len(realm_ids)} realms and {len(aliases)} aliases')
+
+#--------------------------------------------------------------------------------------------------------------------------------------------
+
+def alias2realm(alias):
+    return _ALIASES.get(alias, alias)
 
 #--------------------------------------------------------------------------------------------------------------------------------------------
 
 def add_user(discord_id, home_realm):
-    LOG.info(f'adding user with id {discord_id} {home_realm}')
+    if discord_id in _USERS and _USERS[discord_id] == home_realm:
+        return
 
-    conn = _db_connect()
-    with conn.cursor() as crs:
+    LOG.info(f'adding user with id {discord_id} {home_realm}')
+    with _db_cursor() as crs:
         try:
-            crs.execute('insert into users (`dsc_id`, `home_realm`) values (%s, %s) on duplicate key update home_realm=%s', (discord_id, home_realm, home_realm))
+            crs.execute(_backend().upsert_sql('users', ('dsc_id', 'home_realm'), ('dsc_id',), 'home_realm=NEW.home_realm'), (discord_id, home_realm))
         except:
             raise DatabaseError(f'Failed to add new user with id {discord_id}: {traceback.format_exc()}')
-        conn.commit()
+
+    _USERS[discord_id] = home_realm
+    leaderboard.set_home_realm(discord_id, home_realm)
+    _notify_write(('users',))
+
+#--------------------------------------------------------------------------------------------------------------------------------------------
+
+def queue_user(discord_id, home_realm):
+    """
+    Registers user by the next flush_users call, later calls for the same user overwrite earlier ones. Doesn't touch DB.
+    """
+    with _PENDING_USERS_LOCK:
+        if discord_id in _USERS and _USERS[discord_id] == home_realm:
+            _PENDING_USERS.pop(discord_id, None)
+        else:
+            _PENDING_USERS[discord_id] = home_realm
+
+
+def flush_users():
+    """
+    Writes users queued by queue_user with a single multi-row upsert, returns number of users written.
+    """
+    global _PENDING_USERS
+
+    with _PENDING_USERS_LOCK:
+        pending, _PENDING_USERS = _PENDING_USERS, {}
+    if not pending:
+        return 0
+
+    LOG.info(f'Writing {len(pending)} queued users')
+    try:
+        with _db_cursor() as crs:
+            crs.executemany(_backend().upsert_sql('users', ('dsc_id', 'home_realm'), ('dsc_id',), 'home_realm=NEW.home_realm'), list(pending.items()))
+    except:
+        with _PENDING_USERS_LOCK:
+            # users queued meanwhile are newer
+            _PENDING_USERS = {**pending, **_PENDING_USERS}
+        raise DatabaseError(f'Failed to write queued users: {traceback.format_exc()}')
+
+    for discord_id, home_realm in pending.items():
+        _USERS[discord_id] = home_realm
+        leaderboard.set_home_realm(discord_id, home_realm)
+    _notify_write(('users',))
+    return len(pending)
 
 #--------------------------------------------------------------------------------------------------------------------------------------------
 
 def remove_user(discord_id):
     LOG.info(f'Removing user with id {discord_id}')
 
-    conn = _db_connect()
-    with conn.cursor() as crs:
+    with _db_cursor() as crs:
         try:
             crs.execute('delete from users where dsc_id = %s', discord_id)
         except:
             raise DatabaseError(f'Failed to remove new user with id {discord_id}: {traceback.format_exc()}')
-        conn.commit()
+
+    _USERS.pop(discord_id, None)
+    with _PENDING_USERS_LOCK:
+        _PENDING_USERS.pop(discord_id, None)
+    leaderboard.remove_user(discord_id)
+    _notify_write(('users',))
 
 #--------------------------------------------------------------------------------------------------------------------------------------------
 
 def add_alias(realm_name, alias, update=False):
     LOG.info(f'adding alias {realm_name} as {alias}')
 
-    conn = _db_connect()
-    with conn as crs:
+    with _db_cursor() as crs:
         if not update:
             try:
                 crs.execute('insert into aliases (`realm_name`, `alias`) values(%s, %s)', (realm_name, alias))
-                conn.commit()
-                return True
-            except pymysql.IntegrityError as e:
+            except _backend().IntegrityError as e:
                 raise DatabaseError(e)
         else:
             try:
-                crs.execute('insert into aliases (`realm_name`, `alias`) values(%s, %s) on duplicate key update alias=%s', (realm_name, alias, alias))
-                conn.commit()
-                return True
+                crs.execute(_backend().upsert_sql('aliases', ('realm_name', 'alias'), ('alias',), 'realm_name=NEW.realm_name'), (realm_name, alias))
             except Exception as e:
                 LOG.error(f'{e}, {traceback.format_exc()}')
                 raise DatabaseError('Critical error occurred, contact administrator.')
 
+    _ALIASES[alias] = realm_name
+    return True
+
 #--------------------------------------------------------------------------------------------------------------------------------------------
 
 def add_realm(name):
+    """
+    Returns id of realm, inserting it when missing. Realm added by another process or worker since the cache was loaded is reused.
+    """
     if name not in constants.EU_REALM_NAMES:
         raise UnknownRealmName(f'Realm {name} is not a known EU realm.')
 
-    conn = _db_connect()
-    with conn.cursor() as crs:
+    realm_id = _select_realm_id(name)
+    if realm_id is None:
         try:
-            crs.execute('insert into realms (`name`) values (%s)', name)
+            with _db_cursor() as crs:
+                crs.execute('insert into realms (`name`) values (%s)', name)
+                realm_id = crs.lastrowid
+        except _backend().IntegrityError:
+            # concurrent insert of the same realm committed first
+            realm_id = _select_realm_id(name)
+        except DatabaseError:
+            raise
         except:
             raise DatabaseError(f'Failed to add new realm with name {name}: {traceback.format_exc()}')
-        conn.commit()
-        crs.execute('select id from realms where name=%s', name)
-        return crs.fetchone()
+
+    if realm_id is None:
+        raise DatabaseError(f'Failed to add new realm with name {name}')
+    _REALM_IDS[name] = realm_id
+    return realm_id
+
+
+def _select_realm_id(name):
+    with _db_cursor(read_only=True) as crs:
+        try:
+            crs.execute('select id from realms where name=%s', name)
+            row = crs.fetchone()
+        except:
+            raise DatabaseError(f'Failed to load realm with name {name}: {traceback.format_exc()}')
+    return row[0] if row is not None else None
 
 #--------------------------------------------------------------------------------------------------------------------------------------------
 
@@ -204,24 +677,17 @@ def realm_name2id(name):
     if name is None:
         return None
 
-    with _db_connect() as crs:
-        ret = crs.execute('select id from realms where name=%s', name)
-        if ret == 0:
-            new_realm = add_realm(name)
-            if new_realm:
-                return new_realm
-            else:
-                raise DatabaseError(f'Failed to add new realm with name {name}, {traceback.format_exc()}')
-        elif ret > 1:
-            raise DatabaseError(f'More realms with the same id (wtf did you do?)')
-        else:
-            return crs.fetchone()
+    realm_id = _REALM_IDS.get(name)
+    if realm_id is not None:
+        return realm_id
+
+    return add_realm(name)
 
 #--------------------------------------------------------------------------------------------------------------------------------------------
 
 def user_list2tuple(users: typing.List[discord.User]):
     res = []
-    with _db_connect() as crs:
+    with _db_cursor() as crs:
         for user in users:
             rows = crs.execute('select id, dsc_id, name from users where name=%s', f'{user.name}#{user.discriminator}')
             if rows == 1:
@@ -234,8 +700,160 @@ def user_list2tuple(users: typing.List[discord.User]):
 
 #--------------------------------------------------------------------------------------------------------------------------------------------
 
-def _db_connect():
+def stream_select(sql, on_row, max_rows, timeout):
+    """
+    Runs ad-hoc select on a read only connection and passes rows one by one to on_row as they arrive from server.
+    At most max_rows rows are read, statement is aborted after timeout seconds.
+    Returns (number of rows, truncated).
+    """
+    rows = 0
+    with contextlib.ExitStack() as stack:
+        try:
+            crs = db_stats.TimedCursor(stack.enter_context(_backend().read_only_cursor(timeout)))
+            crs.execute(sql)
+            for row in crs:
+                # read only connection is closed without draining the rest of result set
+                if rows == max_rows:
+                    return rows, True
+                on_row(tuple(row))
+                rows += 1
+        except DatabaseError:
+            raise
+        except Exception as e:
+            LOG.error(f'Ad-hoc query failed: {traceback.format_exc()}')
+            raise DatabaseError(f'Query failed: {e}')
+
+    return rows, False
+
+#--------------------------------------------------------------------------------------------------------------------------------------------
+
+def stream_transactions(on_row, guild_id, since=None, until=None, booster_id=None, cycle_id=None, archived=False, timeout=3600.0):
+    """
+    Passes every matching transaction as (id, type, author_id, booster_id, amount, comment, guild_id, realm_id, date_added, cycle_id) to on_row, oldest first.
+    Rows are read through unbuffered read only cursor, memory use doesn't depend on number of rows.
+    since and until are "YYYY-MM-DD HH:MM:SS" strings, until is exclusive. Returns number of rows.
+    Cycle of live ledger is every row after payout of the previous cycle of guild up to and including payout rows of cycle_id,
+    cycle of archive is every row archived by archiving cycle_id.
+    """
+    table = 'transactions_archive' if archived else 'transactions'
+    conditions = ['guild_id=%s']
+    params = [guild_id]
+    for condition, value in (('date_added >= %s', since), ('date_added < %s', until), ('booster_id=%s', booster_id), ('archive_cycle_id=%s', cycle_id if archived else None)):
+        if value is not None:
+            conditions.append(condition)
+            params.append(value)
+
+    rows = 0
+    with contextlib.ExitStack() as stack:
+        try:
+            crs = db_stats.TimedCursor(stack.enter_context(_backend().read_only_cursor(timeout)))
+            if cycle_id is not None and not archived:
+                # only payout rows carry cycle id, cycle is the id range they close
+                crs.execute(CYCLE_LAST_ID_SQL, (guild_id, cycle_id))
+                last_id, = crs.fetchone()
+                crs.execute(CYCLE_PREVIOUS_LAST_ID_SQL, (guild_id, cycle_id))
+                previous_last_id, = crs.fetchone()
+                conditions.append('id > %s and id <= %s')
+                params.extend((previous_last_id, last_id if last_id is not None else 0))
+            crs.execute(STREAM_TRANSACTIONS_SQL.format(table=table, conditions=' and '.join(conditions)), params)
+            for row in crs:
+                on_row(tuple(row))
+                rows += 1
+        except Exception as e:
+            LOG.error(f'Transaction export failed: {traceback.format_exc()}')
+            raise DatabaseError(f'Export failed: {e}')
+
+    return rows
+
+#--------------------------------------------------------------------------------------------------------------------------------------------
+
+def add_write_listener(listener):
+    """
+    Registers listener(*tags) called after every committed ledger write, from the writing thread.
+    Tags are ('booster', dsc_id), ('guild', guild_id), ('users',) for registry changes and ('all',) when anything may have changed.
+    """
+    _WRITE_LISTENERS.append(listener)
+
+
+def _notify_write(*tags):
+    for listener in _WRITE_LISTENERS:
+        listener(*tags)
+
+#--------------------------------------------------------------------------------------------------------------------------------------------
+
+def ping():
+    """
+    Raises DatabaseError when DB doesn't answer a trivial query.
+    """
+    with _db_cursor(read_only=True) as crs:
+        try:
+            crs.execute('select 1')
+            crs.fetchall()
+        except:
+            raise DatabaseError(f'DB is not reachable: {traceback.format_exc()}')
+
+
+def pool_stats():
+    return _backend().stats()
+
+
+def dialect():
+    return _backend().dialect
+
+#--------------------------------------------------------------------------------------------------------------------------------------------
+
+def set_backend(backend):
+    """
+    Replaces backend selected by config.json, used by tests and tools.
+    """
+    global _BACKEND
+    global _REALM_IDS
+    global _ALIASES
+    with _BACKEND_LOCK:
+        old_backend, _BACKEND = _BACKEND, backend
+        # cached realms and users belong to the old database
+        _REALM_IDS, _ALIASES = {}, {}
+        _USERS.clear()
+    if old_backend is not None:
+        old_backend.close()
+
+#--------------------------------------------------------------------------------------------------------------------------------------------
+
+def _backend():
+    global _BACKEND
+    if _BACKEND is None:
+        with _BACKEND_LOCK:
+            if _BACKEND is None:
+                try:
+                    _BACKEND = db_backends.create(config.get())
+                except:
+                    raise DatabaseError(f'Unable connect to DB! : {traceback.format_exc()}')
+    return _BACKEND
+
+#--------------------------------------------------------------------------------------------------------------------------------------------
+
+@contextlib.contextmanager
+def _db_cursor(read_only=False):
+    """
+    Yields cursor of the configured backend, commits on success and rolls back on any exception.
+    read_only transactions must not write, backend may let them run next to writers.
+    Every statement is timed by db_stats under its call site.
+    Failing checkout or commit raises DatabaseError, exceptions of the with block are raised as they are.
+    """
+    committing = False
     try:
-        return pymysql.connect(**config.get('db_creds'))
+        with contextlib.ExitStack() as stack:
+            try:
+                crs = stack.enter_context(_backend().cursor(read_only))
+            except DatabaseError:
+                raise
+            except:
+                raise DatabaseError(f'Unable connect to DB! : {traceback.format_exc()}')
+            yield db_stats.TimedCursor(crs)
+            committing = True
+    except DatabaseError:
+        raise
     except:
-        raise DatabaseError(f'Unable connect to DB! : {traceback.format_exc()}')
+        if not committing:
+            raise
+        raise DatabaseError(f'Failed to commit DB transaction, reason: {traceback.format_exc()}')
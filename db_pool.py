@@ -0,0 +1,142 @@
+import logging
+import threading
+import time
+import traceback
+from collections import deque
+
+import pymysql
+
+LOG = logging.getLogger(__name__)
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+    """
+    Thread safe pool of reusable pymysql connections.
+    Idle connections are pinged on checkout when they were not used for longer than health_check_interval and replaced when stale.
+    """
+
+    def __init__(self, connect_kwargs, min_size=1, max_size=5, timeout=10.0, health_check_interval=30.0):
+        if min_size > max_size:
+            raise ValueError(f'Pool min_size {min_size} is bigger than max_size {max_size}.')
+
+        self._connect_kwargs = connect_kwargs
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+
+        self._cond = threading.Condition()
+        # (connection, last_used) pairs, most recently returned connection is reused first
+        self._idle = deque()
+        self._size = 0
+        self._in_use = 0
+
+        self._checkouts = 0
+        self._waits = 0
+        self._timeouts = 0
+        self._reconnects = 0
+        self._checkout_time_ttl = 0.0
+        self._checkout_time_max = 0.0
+
+        for _ in range(min_size):
+            self._idle.append((self._new_connection(), time.monotonic()))
+            self._size += 1
+
+    def _new_connection(self):
+        return pymysql.connect(**self._connect_kwargs)
+
+    def acquire(self):
+        start = time.monotonic()
+        with self._cond:
+            conn = None
+            while conn is None:
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                    self._in_use += 1
+                    break
+
+                if self._size < self.max_size:
+                    # reserve the slot, connect outside of the lock
+                    self._size += 1
+                    self._in_use += 1
+                    last_used = None
+                    break
+
+                self._waits += 1
+                remaining = self.timeout - (time.monotonic() - start)
+                if remaining <= 0 or not self._cond.wait(remaining):
+                    if not self._idle and self._size >= self.max_size:
+                        self._timeouts += 1
+                        raise PoolTimeout(f'No DB connection available in {self.timeout}s, {self._in_use} in use.')
+
+        try:
+            if conn is None:
+                conn = self._new_connection()
+            elif time.monotonic() - last_used > self.health_check_interval:
+                conn = self._check_health(conn)
+        except:
+            with self._cond:
+                self._size -= 1
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+
+        elapsed = time.monotonic() - start
+        with self._cond:
+            self._checkouts += 1
+            self._checkout_time_ttl += elapsed
+            self._checkout_time_max = max(self._checkout_time_max, elapsed)
+
+        return conn
+
+    def _check_health(self, conn):
+        try:
+            conn.ping(reconnect=False)
+            return conn
+        except pymysql.Error:
+            LOG.warning('Stale DB connection, reconnecting: %s', traceback.format_exc())
+            self._close_quietly(conn)
+            with self._cond:
+                self._reconnects += 1
+            return self._new_connection()
+
+    def release(self, conn, broken=False):
+        with self._cond:
+            self._in_use -= 1
+            if broken or not conn.open:
+                self._size -= 1
+                self._close_quietly(conn)
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def close(self):
+        with self._cond:
+            while self._idle:
+                conn, _ = self._idle.pop()
+                self._size -= 1
+                self._close_quietly(conn)
+
+    @staticmethod
+    def _close_quietly(conn):
+        try:
+            conn.close()
+        except pymysql.Error:
+            pass
+
+    def stats(self):
+        with self._cond:
+            return {'size': self._size,
+                    'in_use': self._in_use,
+                    'idle': len(self._idle),
+                    'max_size': self.max_size,
+                    'checkouts': self._checkouts,
+                    'waits': self._waits,
+                    'timeouts': self._timeouts,
+                    'reconnects': self._reconnects,
+                    'avg_checkout_ms': (self._checkout_time_ttl / self._checkouts * 1000) if self._checkouts else 0.0,
+                    'max_checkout_ms': self._checkout_time_max * 1000}
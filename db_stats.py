@@ -0,0 +1,144 @@
+import logging
+import sys
+import threading
+import time
+
+import config
+
+LOG = logging.getLogger(__name__)
+# separate logger so slow queries can be routed to their own handler
+SLOW_LOG = logging.getLogger('slow_query')
+
+# upper bounds of latency histogram buckets in ms, last bucket catches everything slower
+BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, float('inf'))
+
+
+class QueryStats:
+    """
+    Latency histogram with call, row and error counters of one call site.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.rows = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.buckets = [0] * len(BUCKETS_MS)
+
+    def add(self, elapsed_ms, rows, error):
+        self.calls += 1
+        self.errors += error
+        self.rows += rows
+        self.total_ms += elapsed_ms
+        self.max_ms = max(self.max_ms, elapsed_ms)
+        for idx, bound in enumerate(BUCKETS_MS):
+            if elapsed_ms <= bound:
+                self.buckets[idx] += 1
+                break
+
+    def percentile(self, q):
+        """
+        Returns upper bound of the bucket holding q-th quantile, max latency for the last bucket.
+        """
+        target = q * self.calls
+        seen = 0
+        for bound, count in zip(BUCKETS_MS, self.buckets):
+            seen += count
+            if count and seen >= target:
+                return min(bound, self.max_ms)
+        return self.max_ms
+
+
+_LOCK = threading.Lock()
+# call site tag -> QueryStats
+_STATS = {}
+
+# --------------------------------------------------------------------------------------------------------------------------------------------
+
+def record(tag, elapsed_ms, rows=0, error=False, sql=None):
+    with _LOCK:
+        stats = _STATS.get(tag)
+        if stats is None:
+            stats = _STATS[tag] = QueryStats()
+        stats.add(elapsed_ms, rows, error)
+
+    if elapsed_ms >= config.get('slow_query_ms', default=500):
+        SLOW_LOG.warning(f'Slow query {tag} took {elapsed_ms:.0f}ms: {" ".join((sql or "").split())[:500]}')
+
+
+def add_rows(tag, rows):
+    with _LOCK:
+        stats = _STATS.get(tag)
+        if stats is not None:
+            stats.rows += rows
+
+
+def snapshot():
+    """
+    Returns list of (tag, calls, errors, rows, avg_ms, p50_ms, p95_ms, max_ms) sorted by total time spent, slowest first.
+    """
+    with _LOCK:
+        items = sorted(_STATS.items(), key=lambda item: item[1].total_ms, reverse=True)
+        return [(tag, s.calls, s.errors, s.rows, s.total_ms / s.calls, s.percentile(0.5), s.percentile(0.95), s.max_ms) for tag, s in items]
+
+
+def reset():
+    with _LOCK:
+        _STATS.clear()
+
+# --------------------------------------------------------------------------------------------------------------------------------------------
+
+class TimedCursor:
+    """
+    Cursor proxy recording every statement under call site of execute, e.g. "add_user:412".
+    Rows are taken from rowcount or counted while fetching when the driver doesn't know it upfront.
+    """
+
+    def __init__(self, crs):
+        self._crs = crs
+        self._tag = None
+        self._count_fetched = False
+
+    def _run(self, method, sql, params):
+        caller = sys._getframe(2)
+        self._tag = f'{caller.f_code.co_name}:{caller.f_lineno}'
+        start = time.perf_counter()
+        try:
+            res = method(sql, params)
+        except:
+            record(self._tag, (time.perf_counter() - start) * 1000, error=True, sql=sql)
+            raise
+
+        rowcount = self._crs.rowcount
+        # sqlite reports -1 for selects, unbuffered pymysql cursor 2 ** 64 - 1
+        self._count_fetched = rowcount is None or rowcount < 0 or rowcount >= 2 ** 63
+        record(self._tag, (time.perf_counter() - start) * 1000, 0 if self._count_fetched else rowcount, sql=sql)
+        return res
+
+    def execute(self, sql, params=None):
+        return self._run(self._crs.execute, sql, params)
+
+    def executemany(self, sql, seq_params):
+        return self._run(self._crs.executemany, sql, seq_params)
+
+    def fetchone(self):
+        row = self._crs.fetchone()
+        if self._count_fetched and row is not None:
+            add_rows(self._tag, 1)
+        return row
+
+    def fetchall(self):
+        rows = self._crs.fetchall()
+        if self._count_fetched:
+            add_rows(self._tag, len(rows))
+        return rows
+
+    def __iter__(self):
+        for row in self._crs:
+            if self._count_fetched:
+                add_rows(self._tag, 1)
+            yield row
+
+    def __getattr__(self, item):
+        return getattr(self._crs, item)
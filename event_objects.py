@@ -68,6 +68,26 @@ class Booster:
         return obj_length
 
 
+@dataclass(frozen=True)
+class BoostHandle:
+    """
+    Location of boost message, edits go through partial message so no Message object has to be kept or fetched.
+    """
+    guild_id: Union[int, None]
+    channel_id: int
+    message_id: int
+
+    @classmethod
+    def from_message(cls, msg: discord.Message):
+        return cls(msg.guild.id if msg.guild else None, msg.channel.id, msg.id)
+
+    def partial_message(self, client: discord.Client) -> discord.PartialMessage:
+        return client.get_partial_messageable(self.channel_id, guild_id=self.guild_id).get_partial_message(self.message_id)
+
+    async def edit(self, client: discord.Client, **kwargs) -> discord.Message:
+        return await self.partial_message(client).edit(**kwargs)
+
+
 @dataclass
 class DummyRole:
     mention: str
@@ -107,13 +127,11 @@ class Boost:
         if self.uuid is None:
             self.uuid = str(uuid.uuid4())
 
-        cuts = config.get('cuts')
+        cuts = config.snapshot().cuts
         if self.realm_name in cuts and self.bigger_adv_cuts:
-            self._adv_cut = cuts[self.realm_name]['adv']
-            self._mng_cut = cuts[self.realm_name]['mng']
+            self._adv_cut, self._mng_cut = cuts[self.realm_name]
         else:
-            self._adv_cut = cuts['default']['adv']
-            self._mng_cut = cuts['default']['mng']
+            self._adv_cut, self._mng_cut = cuts['default']
 
         self.past_team_takes = []
         if self.armor_stack != 'no':
@@ -172,7 +190,7 @@ class Boost:
             if booster.is_tank:
                 res_string += str(globals.emojis['tank'])
             if booster.is_keyholder:
-                res_string += config.get('emojis', 'keyholder')
+                res_string += config.snapshot().emojis['keyholder']
 
             res_string += '\n'
 
@@ -0,0 +1,82 @@
+"""
+Exports ledger transactions to gzipped CSV or JSONL file.
+
+Usage: python export.py GUILD_ID OUT_PATH [--format csv|jsonl] [--since YYYY-MM-DD] [--until YYYY-MM-DD] [--booster ID] [--cycle ID] [--archived]
+"""
+import argparse
+import csv
+import datetime
+import gzip
+import json
+import logging
+import os
+import time
+
+import config
+import db_handling
+
+LOG = logging.getLogger(__name__)
+FORMATS = ('csv', 'jsonl')
+COLUMNS = ('id', 'type', 'author_id', 'booster_id', 'amount', 'comment', 'guild_id', 'realm_id', 'date_added', 'cycle_id')
+
+
+def day2timestamp(day, next_day=False):
+    """
+    Converts "YYYY-MM-DD" to timestamp string used in export filters, start of the following day with next_day.
+    """
+    date = datetime.date.fromisoformat(day)
+    if next_day:
+        date += datetime.timedelta(days=1)
+    return f'{date.isoformat()} 00:00:00'
+
+# --------------------------------------------------------------------------------------------------------------------------------------------
+
+def export_transactions(path, guild_id, format='csv', since=None, until=None, booster_id=None, cycle_id=None, archived=False):
+    """
+    Streams transactions of guild matching filters into gzipped file at path, since and until are "YYYY-MM-DD" days, both inclusive.
+    Returns number of exported rows.
+    """
+    if format not in FORMATS:
+        raise ValueError(f'Unknown export format "{format}", use {" or ".join(FORMATS)}.')
+
+    started = time.monotonic()
+    try:
+        with gzip.open(path, 'wt', encoding='utf-8', newline='') as f:
+            if format == 'csv':
+                writer = csv.writer(f)
+                writer.writerow(COLUMNS)
+                on_row = writer.writerow
+            else:
+                def on_row(row):
+                    f.write(json.dumps(dict(zip(COLUMNS, row)), default=str) + '\n')
+
+            rows = db_handling.stream_transactions(on_row, guild_id,
+                                                   since=day2timestamp(since) if since else None,
+                                                   until=day2timestamp(until, next_day=True) if until else None,
+                                                   booster_id=booster_id, cycle_id=cycle_id, archived=archived,
+                                                   timeout=config.get('export_timeout', default=3600.0))
+    except BaseException:
+        # partial export is never left behind
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+
+    LOG.info(f'Exported {rows} transactions of guild {guild_id} to {path} in {time.monotonic() - started:.1f}s')
+    return rows
+
+# --------------------------------------------------------------------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)-23s %(name)-12s %(levelname)-8s %(message)s')
+    parser = argparse.ArgumentParser(description='Exports ledger transactions to gzipped CSV or JSONL file.')
+    parser.add_argument('guild_id', type=int)
+    parser.add_argument('path', help='output file, e.g. ledger.csv.gz')
+    parser.add_argument('--format', choices=FORMATS, default='csv')
+    parser.add_argument('--since', help='first day, YYYY-MM-DD')
+    parser.add_argument('--until', help='last day, YYYY-MM-DD')
+    parser.add_argument('--booster', type=int, dest='booster_id')
+    parser.add_argument('--cycle', type=int, dest='cycle_id', help='ledger of one payout cycle, with --archived rows archived by that cycle')
+    parser.add_argument('--archived', action='store_true', help='export archived cycles instead of live ledger')
+    args = parser.parse_args()
+
+    export_transactions(args.path, args.guild_id, args.format, args.since, args.until, args.booster_id, args.cycle_id, args.archived)
@@ -7,6 +7,58 @@ import logging
 LOG = logging.getLogger(__name__)
 
 
+class BoostRegistry:
+    """
+    Open boosts by uuid with index of their message ids, entries are (boost_handle, (boost, lock)).
+    Both indexes are updated together without awaiting in between so reaction routing never sees them out of sync.
+    """
+
+    def __init__(self):
+        self._by_uuid = {}
+        self._by_msg_id = {}
+
+    def add(self, boost_handle, boost, lock):
+        old = self._by_uuid.get(boost.uuid)
+        if old is not None:
+            self._by_msg_id.pop(old[0].message_id, None)
+        self._by_uuid[boost.uuid] = (boost_handle, (boost, lock))
+        self._by_msg_id[boost_handle.message_id] = boost.uuid
+
+    def pop(self, boost_uuid, default=None):
+        entry = self._by_uuid.pop(boost_uuid, None)
+        if entry is None:
+            return default
+        self._by_msg_id.pop(entry[0].message_id, None)
+        return entry
+
+    def uuid_by_msg_id(self, msg_id):
+        return self._by_msg_id.get(msg_id)
+
+    def has_msg_id(self, msg_id):
+        return msg_id in self._by_msg_id
+
+    def get(self, boost_uuid, default=None):
+        return self._by_uuid.get(boost_uuid, default)
+
+    def items(self):
+        return self._by_uuid.items()
+
+    def values(self):
+        return self._by_uuid.values()
+
+    def __getitem__(self, boost_uuid):
+        return self._by_uuid[boost_uuid]
+
+    def __contains__(self, boost_uuid):
+        return boost_uuid in self._by_uuid
+
+    def __iter__(self):
+        return iter(self._by_uuid)
+
+    def __len__(self):
+        return len(self._by_uuid)
+
+
 def init():
     global tracked_msgs
     global open_boosts
@@ -17,23 +69,29 @@ def init():
     global loaded
 
     tracked_msgs = {}
-    open_boosts = {}
+    open_boosts = BoostRegistry()
     unprocessed_transactions = {}
     lock = asyncio.Lock()
     known_roles = {}
     loaded = False
 
 
-async def init_discord_objects(client):
+def load_emojis(client):
     global emojis
+
+    emoji_ids = config.snapshot().emojis
+    emojis = {'dps': client.get_emoji(emoji_ids['dps']),
+              'tank': client.get_emoji(emoji_ids['tank']),
+              'healer': client.get_emoji(emoji_ids['healer'])}
+
+
+async def init_discord_objects(client):
     global known_roles
     global open_boosts
     global unprocessed_transactions
     global loaded
 
-    emojis = {'dps': client.get_emoji(config.get('emojis', 'dps')),
-              'tank': client.get_emoji(config.get('emojis', 'tank')),
-              'healer': client.get_emoji(config.get('emojis', 'healer'))}
+    load_emojis(client)
 
     #TODO ugly
     keyblasters_roles = [guild for guild in client.guilds if guild.id == 442319306030710785][0].roles
@@ -43,15 +101,17 @@ async def init_discord_objects(client):
                    }
 
     if os.path.exists('cache.pickle'):
+        # event_objects imports globals
+        from event_objects import BoostHandle
+
         with open('cache.pickle', 'rb') as f:
             open_boosts_data, unprocessed_transactions = pickle.load(f)
 
+        # messages are not fetched, boost whose message was deleted is dropped on its first failed edit
         for (channel_id, message_id), boost in open_boosts_data.items():
-            try:
-                msg_obj = await client.get_channel(channel_id).fetch_message(message_id)
-                LOG.debug('Boost msg: %s', msg_obj)
-                open_boosts[boost.uuid] = (msg_obj, (boost, asyncio.Lock()))
-            except:
-                LOG.error('Failed to load boost message from channel: %s msg_id: %s for boost %s', channel_id, message_id, boost)
+            guild = getattr(client.get_channel(channel_id), 'guild', None)
+            boost_handle = BoostHandle(guild.id if guild is not None else None, channel_id, message_id)
+            LOG.debug('Boost msg: %s', boost_handle)
+            open_boosts.add(boost_handle, boost, asyncio.Lock())
 
     loaded = True
@@ -3,11 +3,13 @@ import logging
 import datetime
 from typing import List, Union
 import asyncio
+import enum
 
 import discord
 from discord.ext.commands.errors import BadArgument
 from dateutil import tz
 
+import config
 import constants
 import globals
 
@@ -149,9 +151,47 @@ def user_has_any_role(user_roles: List[discord.Role], roles_to_check: List[Union
 
 
 def msg_id2boost_uuid(msg_id):
-    for boost_uuid, boost in globals.open_boosts.items():
-        if boost[0].id == msg_id:
-            return boost_uuid
+    return globals.open_boosts.uuid_by_msg_id(msg_id)
+
+
+class ControlEmoji(enum.Enum):
+    """
+    Reactions controlling boosts and approvals, value is the key in emojis config.
+    """
+    TANK = 'tank'
+    HEALER = 'healer'
+    DPS = 'dps'
+    KEYHOLDER = 'keyholder'
+    TEAM = 'team'
+    PROCESS = 'process'
+    YES = 'yes'
+
+
+ROLE_EMOJIS = (ControlEmoji.DPS, ControlEmoji.TANK, ControlEmoji.HEALER, ControlEmoji.KEYHOLDER)
+# custom emoji id or unicode emoji -> ControlEmoji, built from config once
+_CONTROL_EMOJIS = None
+
+
+def load_control_emojis():
+    global _CONTROL_EMOJIS
+    emojis = config.snapshot().emojis
+    _CONTROL_EMOJIS = {emojis[control.value]: control for control in ControlEmoji if control.value in emojis}
+
+
+def classify_emoji(emoji: discord.PartialEmoji):
+    """
+    Returns ControlEmoji of reaction emoji or None for any other emoji.
+    """
+    if _CONTROL_EMOJIS is None:
+        load_control_emojis()
+    return _CONTROL_EMOJIS.get(emoji.id if emoji.id is not None else emoji.name)
+
+
+def is_routed_message(msg_id):
+    """
+    Checks if reactions on message are handled by bot, without any API call.
+    """
+    return globals.open_boosts.has_msg_id(msg_id) or msg_id in globals.unprocessed_transactions or str(msg_id) in globals.tracked_msgs
 
 # --------------------------------------------------------------------------------------------------------------------------------------------
 
@@ -0,0 +1,221 @@
+"""
+Bulk imports ledger transactions from CSV file (optionally gzipped).
+
+Usage: python import_ledger.py GUILD_ID AUTHOR_ID PATH [--chunk-size N]
+
+Header has to contain type, booster and amount columns, home_realm, realm, comment and date columns are optional.
+booster is a mention or discord id, amount accepts the same formats as !g, e.g. 1500, 20k or 1m.
+date is YYYY-MM-DD or YYYY-MM-DD HH:MM:SS in DB time (UTC for SQLite), rows without it are dated at import.
+Rejected rows are written to PATH.rejects.csv, progress is checkpointed to PATH.checkpoint and a rerun resumes after the last committed chunk,
+rejects of rows after the checkpoint are cut from PATH.rejects.csv and written again.
+"""
+import argparse
+import csv
+import datetime
+import functools
+import gzip
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+import uuid
+
+from discord.ext.commands.errors import BadArgument
+
+import config
+import constants
+import db_handling
+import leaderboard
+from helper_functions import gold_str2int
+
+LOG = logging.getLogger(__name__)
+# namespace of journal ids of imported rows, same file and row always map to the same id so a replayed chunk is skipped by the ledger
+IMPORT_NAMESPACE = uuid.UUID('6f1c2a52-7d1e-4c57-9a53-0c3b8f7e2d41')
+REQUIRED_COLUMNS = ('type', 'booster', 'amount')
+_BOOSTER_RE = re.compile(r'^<@!?([0-9]+)>$|^([0-9]+)$')
+
+
+class ImportFileError(Exception):
+    pass
+
+
+def _open(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8', newline='')
+    return open(path, encoding='utf-8', newline='')
+
+
+def _file_digest(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(2 ** 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _read_checkpoint(path, digest):
+    """
+    Returns (rows, rejects_size) of last committed chunk, rejects_size is None for checkpoints which didn't record it.
+    """
+    try:
+        with open(path) as f:
+            checkpoint = json.load(f)
+    except FileNotFoundError:
+        return 0, 0
+
+    if checkpoint['digest'] != digest:
+        raise ImportFileError(f'Checkpoint {path} belongs to a different file, remove it to start over.')
+    return checkpoint['rows'], checkpoint.get('rejects_size')
+
+
+def _write_checkpoint(path, digest, rows, rejects_size):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'digest': digest, 'rows': rows, 'rejects_size': rejects_size}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+@functools.lru_cache(maxsize=None)
+def _valid_realm(realm_name):
+    return constants.is_valid_realm(realm_name, True)
+
+# --------------------------------------------------------------------------------------------------------------------------------------------
+
+def parse_row(row):
+    """
+    Validates one CSV row, returns (type, booster_id, home_realm, amount, comment, realm_name, date_added) entry or raises ValueError.
+    """
+    type = (row.get('type') or '').strip().lower()
+    if type not in db_handling.TRANSACTIONS:
+        raise ValueError(f'Unknown transaction type "{type}"')
+
+    booster = (row.get('booster') or '').strip()
+    m = _BOOSTER_RE.match(booster)
+    if not m:
+        raise ValueError(f'"{booster}" is not a mention or discord id')
+    booster_id = int(m.group(1) or m.group(2))
+
+    try:
+        amount = gold_str2int((row.get('amount') or '').strip())
+    except BadArgument as e:
+        raise ValueError(str(e))
+    error = db_handling.validate_transaction(type, amount)
+    if error is not None:
+        raise ValueError(error)
+
+    realms = []
+    for column in ('home_realm', 'realm'):
+        realm_name = (row.get(column) or '').strip() or None
+        if realm_name is not None:
+            try:
+                realm_name = _valid_realm(realm_name)
+            except BadArgument as e:
+                raise ValueError(str(e))
+        realms.append(realm_name)
+    home_realm, realm_name = realms
+
+    # registered users keep their home realm when the file doesn't know it
+    if home_realm is None:
+        home_realm = leaderboard.home_realm(booster_id)
+
+    date_added = (row.get('date') or '').strip() or None
+    if date_added is not None:
+        try:
+            date_added = datetime.datetime.fromisoformat(date_added).strftime('%Y-%m-%d %H:%M:%S')
+        except ValueError:
+            raise ValueError(f'"{date_added}" is not a YYYY-MM-DD or YYYY-MM-DD HH:MM:SS date')
+
+    return type, booster_id, home_realm, amount, (row.get('comment') or '').strip() or None, realm_name or home_realm, date_added
+
+# --------------------------------------------------------------------------------------------------------------------------------------------
+
+def import_transactions(path, guild_id, author_id, chunk_size=5000):
+    """
+    Imports transactions of path into ledger of guild, every chunk of chunk_size rows is one DB transaction.
+    Only the first chunk of a run looks up journal ids of its rows, it may have been committed by a crashed run before its checkpoint.
+    Returns (imported, rejected) row counts of this run.
+    """
+    digest = _file_digest(path)
+    checkpoint_path = path + '.checkpoint'
+    done, rejects_size = _read_checkpoint(checkpoint_path, digest)
+    if done:
+        LOG.info(f'Resuming {path} after {done} rows')
+
+    db_handling.load_realm_cache()
+    db_handling.load_leaderboards()
+
+    imported = 0
+    rejected = 0
+    started = time.monotonic()
+    with _open(path) as f, open(path + '.rejects.csv', 'a', encoding='utf-8', newline='') as rejects_file:
+        if rejects_size is not None:
+            # rejects after the checkpoint are written again by this run
+            rejects_file.truncate(rejects_size)
+        reader = csv.DictReader(f)
+        missing = [column for column in REQUIRED_COLUMNS if column not in (reader.fieldnames or [])]
+        if missing:
+            raise ImportFileError(f'Missing columns {", ".join(missing)} in {path}.')
+        rejects = csv.writer(rejects_file)
+
+        entries = []
+        journal_ids = []
+        row_no = 0
+        first_chunk = True
+
+        def load_chunk():
+            nonlocal imported
+            nonlocal rejected
+            nonlocal first_chunk
+            results = db_handling.add_transactions_batch(entries, author_id, guild_id, journal_ids=journal_ids, check_journal_ids=first_chunk)
+            first_chunk = False
+            for (entry, journal_id), (_, _, error) in zip(zip(entries, journal_ids), results):
+                if error is None:
+                    imported += 1
+                elif error != 'Already processed':
+                    rejected += 1
+                    rejects.writerow((journal_id, *entry, error))
+            rejects_file.flush()
+            _write_checkpoint(checkpoint_path, digest, row_no, os.fstat(rejects_file.fileno()).st_size)
+            entries.clear()
+            journal_ids.clear()
+
+            elapsed = time.monotonic() - started
+            LOG.info(f'{row_no} rows done, {imported} imported, {rejected} rejected, {imported / elapsed if elapsed else 0:.0f} rows/s')
+
+        for row in reader:
+            row_no += 1
+            if row_no <= done:
+                continue
+
+            try:
+                entries.append(parse_row(row))
+            except ValueError as e:
+                rejected += 1
+                rejects.writerow((f'line {reader.line_num}', *row.values(), e))
+                continue
+            journal_ids.append(str(uuid.uuid5(IMPORT_NAMESPACE, f'{digest}:{row_no}')))
+
+            if len(entries) >= chunk_size:
+                load_chunk()
+
+        if entries or row_no > done:
+            load_chunk()
+
+    LOG.info(f'Imported {imported} rows, rejected {rejected} in {time.monotonic() - started:.1f}s, run "!balances rebuild" to reload leaderboards of running bot')
+    return imported, rejected
+
+# --------------------------------------------------------------------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)-23s %(name)-12s %(levelname)-8s %(message)s')
+    parser = argparse.ArgumentParser(description='Bulk imports ledger transactions from CSV file.')
+    parser.add_argument('guild_id', type=int)
+    parser.add_argument('author_id', type=int, help='discord id recorded as author of imported transactions')
+    parser.add_argument('path')
+    parser.add_argument('--chunk-size', type=int, default=config.get('import_chunk_size', default=5000))
+    args = parser.parse_args()
+
+    import_transactions(args.path, args.guild_id, args.author_id, args.chunk_size)
@@ -0,0 +1,310 @@
+import itertools
+import json
+import logging
+import os
+import threading
+import uuid
+
+import config
+import db_handling
+
+LOG = logging.getLogger(__name__)
+
+
+class Journal:
+    """
+    Append-only file of ledger writes waiting for DB.
+    Every record is fsync'd before append returns, offset of the prefix already written to DB is kept in <path>.offset.
+    Batch failing max_attempts flushes in a row while DB is reachable is moved to <path>.dead so it doesn't block later records.
+    Line torn by a crash during append was never acknowledged, it is cut off when the journal is opened.
+    """
+
+    def __init__(self, path, batch_size=500, compact_size=2 ** 20, max_attempts=5):
+        self.path = path
+        self.offset_path = path + '.offset'
+        self.dead_path = path + '.dead'
+        self.batch_size = batch_size
+        self.compact_size = compact_size
+        self.max_attempts = max_attempts
+        # records moved to dead letter file by this process
+        self.dead_lettered = 0
+        # (end offset of failing batch, failed attempts)
+        self._failures = (None, 0)
+        self._lock = threading.Lock()
+        # only one flush at a time, appends are never blocked by DB
+        self._flush_lock = threading.Lock()
+        # end offset of the last undecodable line moved to dead letter file
+        self._dead_upto = 0
+        self._cut_torn_line()
+
+    def append(self, entries, author_id, guild_id, boost_uuid=None):
+        """
+        Durably records list of (type, booster_id, home_realm, amount, comment[, realm_name]) entries, optionally as payout of boost.
+        Returns list of (booster_id, amount, error) in the order of entries, only entries without error are recorded.
+        """
+        results = []
+        lines = []
+        # records of one call are written to DB together, e.g. all lines of one boost approval
+        append_id = str(uuid.uuid4())
+        for entry in entries:
+            type, booster_id, home_realm, amount, comment = entry[:5]
+            realm_name = entry[5] if len(entry) > 5 else home_realm
+            error = db_handling.validate_transaction(type, amount)
+            results.append((booster_id, amount, error))
+            if error is None:
+                record = {'journal_id': str(uuid.uuid4()), 'author_id': author_id, 'guild_id': guild_id,
+                          'type': type, 'booster_id': booster_id, 'home_realm': home_realm, 'amount': amount, 'comment': comment,
+                          'realm_name': realm_name, 'boost_uuid': boost_uuid, 'append_id': append_id}
+                lines.append(json.dumps(record) + '\n')
+
+        if lines:
+            self._append_lines(lines)
+
+        return results
+
+    def _append_lines(self, lines):
+        data = memoryview(''.join(lines).encode('utf-8'))
+        with self._lock:
+            with open(self.path, 'ab', buffering=0) as f:
+                size = f.seek(0, os.SEEK_END)
+                try:
+                    while data:
+                        data = data[f.write(data):]
+                    os.fsync(f.fileno())
+                except:
+                    # nothing of a failed append is acknowledged, file has to keep ending with a whole line
+                    os.ftruncate(f.fileno(), size)
+                    raise
+
+    def _cut_torn_line(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb+') as f:
+            size = f.seek(0, os.SEEK_END)
+            end = size
+            # torn tail is shorter than one append, walk back to the last newline
+            while end > 0:
+                start = max(0, end - 2 ** 16)
+                f.seek(start)
+                newline = f.read(end - start).rfind(b'\n')
+                if newline != -1:
+                    end = start + newline + 1
+                    break
+                end = start
+            if end != size:
+                LOG.warning(f'Cutting {size - end} bytes of torn line off {self.path}')
+                f.truncate(end)
+                os.fsync(f.fileno())
+
+    def pending(self):
+        """
+        Returns list of (end_offset, record) not yet written to DB, a torn last line is left for the next read.
+        Lines that are not valid records are moved to dead letter file.
+        """
+        return self._pending()[0]
+
+    def _pending(self):
+        # also returns end offset of the last whole line read, it can be past the last record
+        with self._lock:
+            offset = self._read_offset()
+            if not os.path.exists(self.path):
+                return [], offset
+
+            with open(self.path, 'rb') as f:
+                if offset > os.fstat(f.fileno()).st_size:
+                    offset = 0
+                f.seek(offset)
+                data = f.read()
+
+            records = []
+            for line in data.splitlines(keepends=True):
+                if not line.endswith(b'\n'):
+                    break
+                offset += len(line)
+                try:
+                    record = json.loads(line)
+                    if isinstance(record, dict) and 'journal_id' in record:
+                        records.append((offset, record))
+                        continue
+                except ValueError:
+                    pass
+                # lines before the offset of this flush stay in the file, move each of them only once
+                if offset > self._dead_upto:
+                    self._dead_letter_lines([line.decode('utf-8', errors='replace')])
+                    self._dead_upto = offset
+                    LOG.error(f'Moved undecodable journal line ending at {offset} to {self.dead_path}')
+        return records, offset
+
+    def flush(self):
+        """
+        Writes pending records to DB in batches, returns number of records flushed.
+        Records are deduplicated by journal id so replaying a batch that was committed before a crash is a no-op.
+        Records of one boost approval are never split, ledger keeps one row per booster and type of a boost and would drop the rest as already processed.
+        """
+        with self._flush_lock:
+            return self._flush()
+
+    def flush_then(self, func, *args, **kwargs):
+        """
+        Flushes pending records and calls func while no other flush runs, e.g. payout has to include every acknowledged approval.
+        """
+        with self._flush_lock:
+            self._flush()
+            return func(*args, **kwargs)
+
+    def requeue_dead(self):
+        """
+        Moves dead letter records back to the journal to be retried by next flush, returns number of records.
+        Records keep their journal ids so records already written by an earlier attempt are skipped.
+        """
+        with self._flush_lock:
+            if not os.path.exists(self.dead_path):
+                return 0
+            with open(self.dead_path, encoding='utf-8') as f:
+                lines = [line for line in f if line.endswith('\n')]
+
+            if lines:
+                self._append_lines(lines)
+            # crash before truncation only requeues the same records again
+            os.remove(self.dead_path)
+            return len(lines)
+
+    def dead_count(self):
+        if not os.path.exists(self.dead_path):
+            return 0
+        with open(self.dead_path, encoding='utf-8') as f:
+            return sum(1 for _ in f)
+
+    def _flush(self):
+        records, end_offset = self._pending()
+        flushed = 0
+        for (author_id, guild_id, boost_uuid, _), group in itertools.groupby(records, key=self._batch_key):
+            group = list(group)
+            step = len(group) if boost_uuid is not None else self.batch_size
+            for start in range(0, len(group), step):
+                batch = group[start:start + step]
+                try:
+                    results = db_handling.add_transactions_batch([(r['type'], r['booster_id'], r['home_realm'], r['amount'], r['comment'], r.get('realm_name', r['home_realm'])) for _, r in batch],
+                                                                 author_id, guild_id, journal_ids=[r['journal_id'] for _, r in batch], boost_uuid=boost_uuid)
+                except db_handling.DatabaseError:
+                    if not self._is_poison(batch):
+                        raise
+                    self._dead_letter(batch)
+                    results = []
+
+                self._failures = (None, 0)
+                for (_, record), (_, _, error) in zip(batch, results):
+                    if error is not None:
+                        LOG.warning(f'Journal record {record["journal_id"]} not written: {error}')
+                flushed += len(batch)
+                self._write_offset(batch[-1][0])
+
+        # undecodable lines after the last record are already dead lettered
+        if end_offset > self._read_offset():
+            self._write_offset(end_offset)
+        if flushed:
+            LOG.info(f'Flushed {flushed} journal records')
+        self._compact()
+        return flushed
+
+    def _is_poison(self, batch):
+        # retrying is pointless only when the same batch keeps failing while DB answers other queries
+        end_offset = batch[-1][0]
+        failing_offset, attempts = self._failures
+        attempts = attempts + 1 if failing_offset == end_offset else 1
+        self._failures = (end_offset, attempts)
+        if attempts < self.max_attempts:
+            return False
+
+        try:
+            db_handling.ping()
+        except db_handling.DatabaseError:
+            return False
+        return True
+
+    def _dead_letter(self, batch):
+        self._dead_letter_lines([json.dumps(record) + '\n' for _, record in batch])
+        LOG.error(f'Moved {len(batch)} journal records failing {self.max_attempts} times to {self.dead_path}: {[record["journal_id"] for _, record in batch]}')
+
+    def _dead_letter_lines(self, lines):
+        with open(self.dead_path, 'a', encoding='utf-8') as f:
+            f.write(''.join(lines))
+            f.flush()
+            os.fsync(f.fileno())
+        self.dead_lettered += len(lines)
+
+    @staticmethod
+    def _batch_key(item):
+        # one DB batch per run of records with the same author and guild, boost records only with records of the same append call
+        record = item[1]
+        boost_uuid = record.get('boost_uuid')
+        return record['author_id'], record['guild_id'], boost_uuid, record.get('append_id') if boost_uuid is not None else None
+
+    def _compact(self):
+        with self._lock:
+            if not os.path.exists(self.path):
+                return
+            size = os.path.getsize(self.path)
+            if size < self.compact_size or self._read_offset() != size:
+                return
+
+            # offset is reset first, crash in between only replays already flushed records
+            self._write_offset(0)
+            self._dead_upto = 0
+            with open(self.path, 'w', encoding='utf-8') as f:
+                os.fsync(f.fileno())
+
+    def _read_offset(self):
+        try:
+            with open(self.offset_path) as f:
+                return int(f.read().strip() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def _write_offset(self, offset):
+        tmp_path = self.offset_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(str(offset))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.offset_path)
+
+# --------------------------------------------------------------------------------------------------------------------------------------------
+
+_JOURNAL = None
+
+
+def _journal():
+    global _JOURNAL
+    if _JOURNAL is None:
+        _JOURNAL = Journal(config.get('journal_path', default='ledger_journal.jsonl'), batch_size=config.get('journal_batch_size', default=500),
+                           max_attempts=config.get('journal_max_attempts', default=5))
+    return _JOURNAL
+
+
+def append(entries, author_id, guild_id, boost_uuid=None):
+    return _journal().append(entries, author_id, guild_id, boost_uuid)
+
+
+def flush():
+    return _journal().flush()
+
+
+def flush_then(func, *args, **kwargs):
+    return _journal().flush_then(func, *args, **kwargs)
+
+
+def requeue_dead():
+    return _journal().requeue_dead()
+
+
+def pending_count():
+    return len(_journal().pending())
+
+
+def dead_count():
+    return _journal().dead_count()
+
+
+def dead_lettered():
+    return _journal().dead_lettered
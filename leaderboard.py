@@ -0,0 +1,137 @@
+import bisect
+import logging
+import threading
+from collections import defaultdict
+
+LOG = logging.getLogger(__name__)
+
+
+class Leaderboard:
+    """
+    Ordered index of non-zero balances, highest balance first.
+    Rank and top-N lookups are binary searches over sorted (-amount, booster_id) keys.
+    """
+
+    def __init__(self):
+        self._keys = []
+        self._amounts = {}
+
+    def __len__(self):
+        return len(self._keys)
+
+    def set(self, booster_id, amount):
+        self.remove(booster_id)
+        if amount:
+            bisect.insort(self._keys, (-amount, booster_id))
+            self._amounts[booster_id] = amount
+
+    def remove(self, booster_id):
+        amount = self._amounts.pop(booster_id, None)
+        if amount is not None:
+            del self._keys[bisect.bisect_left(self._keys, (-amount, booster_id))]
+
+    def top(self, limit):
+        return [(-neg_amount, booster_id) for neg_amount, booster_id in self._keys[:limit]]
+
+    def rank(self, booster_id):
+        """
+        Returns (1-based rank, amount) or None when booster has no balance on this board.
+        """
+        amount = self._amounts.get(booster_id)
+        if amount is None:
+            return None
+        return bisect.bisect_left(self._keys, (-amount, booster_id)) + 1, amount
+
+
+_LOCK = threading.Lock()
+# booster_id -> {guild_id: balance} for every booster with ledger rows, registered or not
+_BALANCES = defaultdict(dict)
+# booster_id -> home realm of users registered in users table
+_HOME_REALMS = {}
+_GUILD_BOARDS = defaultdict(Leaderboard)
+_REALM_BOARDS = defaultdict(Leaderboard)
+
+# --------------------------------------------------------------------------------------------------------------------------------------------
+
+def seed(balance_rows, user_rows):
+    """
+    Rebuilds all boards from (guild_id, booster_id, amount) balance rows and (dsc_id, home_realm) rows of registered users.
+    """
+    global _GUILD_BOARDS
+    global _REALM_BOARDS
+
+    with _LOCK:
+        _BALANCES.clear()
+        _HOME_REALMS.clear()
+        _GUILD_BOARDS = defaultdict(Leaderboard)
+        _REALM_BOARDS = defaultdict(Leaderboard)
+
+        for dsc_id, home_realm in user_rows:
+            _HOME_REALMS[dsc_id] = home_realm
+
+        for guild_id, booster_id, amount in balance_rows:
+            _BALANCES[booster_id][guild_id] = amount
+            home_realm = _HOME_REALMS.get(booster_id)
+            if home_realm is not None:
+                _GUILD_BOARDS[guild_id].set(booster_id, amount)
+                _REALM_BOARDS[(guild_id, home_realm)].set(booster_id, amount)
+
+    LOG.info(f'Seeded leaderboards for {len(_GUILD_BOARDS)} guilds')
+
+
+def apply_delta(guild_id, booster_id, delta):
+    with _LOCK:
+        amount = _BALANCES[booster_id].get(guild_id, 0) + delta
+        _BALANCES[booster_id][guild_id] = amount
+
+        home_realm = _HOME_REALMS.get(booster_id)
+        if home_realm is not None:
+            _GUILD_BOARDS[guild_id].set(booster_id, amount)
+            _REALM_BOARDS[(guild_id, home_realm)].set(booster_id, amount)
+
+
+def set_home_realm(booster_id, home_realm):
+    with _LOCK:
+        old_realm = _HOME_REALMS.get(booster_id)
+        if old_realm == home_realm:
+            return
+
+        _HOME_REALMS[booster_id] = home_realm
+        for guild_id, amount in _BALANCES.get(booster_id, {}).items():
+            if old_realm is not None:
+                _REALM_BOARDS[(guild_id, old_realm)].remove(booster_id)
+            _GUILD_BOARDS[guild_id].set(booster_id, amount)
+            _REALM_BOARDS[(guild_id, home_realm)].set(booster_id, amount)
+
+
+def remove_user(booster_id):
+    with _LOCK:
+        home_realm = _HOME_REALMS.pop(booster_id, None)
+        if home_realm is None:
+            return
+
+        for guild_id in _BALANCES.get(booster_id, {}):
+            _GUILD_BOARDS[guild_id].remove(booster_id)
+            _REALM_BOARDS[(guild_id, home_realm)].remove(booster_id)
+
+# --------------------------------------------------------------------------------------------------------------------------------------------
+
+def top(guild_id, limit, realm_name=None):
+    """
+    Returns up to limit (amount, booster_id) pairs, highest balance first.
+    """
+    with _LOCK:
+        if realm_name is None:
+            return _GUILD_BOARDS[guild_id].top(limit)
+        return _REALM_BOARDS[(guild_id, realm_name)].top(limit)
+
+
+def rank(guild_id, booster_id, realm_name=None):
+    with _LOCK:
+        if realm_name is None:
+            return _GUILD_BOARDS[guild_id].rank(booster_id)
+        return _REALM_BOARDS[(guild_id, realm_name)].rank(booster_id)
+
+
+def home_realm(booster_id):
+    return _HOME_REALMS.get(booster_id)
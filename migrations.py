@@ -0,0 +1,300 @@
+"""
+Versioned schema of the ledger database.
+
+Usage: python migrations.py migrate|check
+"""
+import logging
+import sys
+
+import db_handling
+
+LOG = logging.getLogger(__name__)
+
+
+class SchemaError(Exception):
+    pass
+
+# --------------------------------------------------------------------------------------------------------------------------------------------
+
+def _dialect_ddl(mysql, sqlite):
+    def step(crs):
+        crs.execute(mysql if db_handling.dialect() == 'mysql' else sqlite)
+    step.__doc__ = mysql
+    return step
+
+
+def _create_index(table, name, columns, unique=False):
+    def step(crs):
+        if db_handling.dialect() == 'sqlite':
+            crs.execute(f'create {"unique " if unique else ""}index if not exists `{name}` on `{table}` ({columns})')
+            return
+
+        crs.execute('select 1 from information_schema.statistics where table_schema=database() and table_name=%s and index_name=%s', (table, name))
+        if crs.fetchone() is None:
+            crs.execute(f'create {"unique " if unique else ""}index `{name}` on `{table}` ({columns})')
+    step.__doc__ = f'index {name} on {table}({columns})'
+    return step
+
+
+def _add_column(table, name, definition):
+    def step(crs):
+        if db_handling.dialect() == 'sqlite':
+            crs.execute(f'pragma table_info(`{table}`)')
+            exists = any(column[1] == name for column in crs.fetchall())
+        else:
+            crs.execute('select 1 from information_schema.columns where table_schema=database() and table_name=%s and column_name=%s', (table, name))
+            exists = crs.fetchone() is not None
+        if not exists:
+            crs.execute(f'alter table `{table}` add column `{name}` {definition}')
+    step.__doc__ = f'column {table}.{name}'
+    return step
+
+
+def _backfill_boost_uuids(crs):
+    """
+    boost uuid from comment of approved boost payouts
+    """
+    # comment of approvals is the bare uuid4, only first row of a booster is tagged when a boost was approved twice
+    crs.execute('update transactions set boost_uuid = comment where id in ('
+                ' select id from (select min(id) as id from transactions where type = \'add\' and boost_uuid is null and comment like %s group by comment, booster_id, type) as firsts)',
+                '________-____-____-____-____________')
+    crs.execute('update transactions_archive set boost_uuid = comment where type = \'add\' and boost_uuid is null and comment like %s', '________-____-____-____-____________')
+
+
+def _backfill_balances(crs):
+    crs.execute('select count(*) from balances')
+    if crs.fetchone()[0] == 0:
+        crs.execute('insert into balances (`guild_id`, `booster_id`, `amount`) select guild_id, booster_id, sum(amount) from transactions group by guild_id, booster_id')
+
+# --------------------------------------------------------------------------------------------------------------------------------------------
+
+# (version, description, steps), step is either DDL string valid in all dialects or callable taking cursor, every step has to be safe to re-run
+MIGRATIONS = [
+    (1, 'base ledger tables', [
+        _dialect_ddl('create table if not exists users ('
+                     ' id int not null auto_increment primary key,'
+                     ' dsc_id bigint not null,'
+                     ' home_realm varchar(64) null,'
+                     ' unique key users_dsc_id (dsc_id))',
+                     'create table if not exists users ('
+                     ' id integer primary key autoincrement,'
+                     ' dsc_id bigint not null unique,'
+                     ' home_realm varchar(64) null)'),
+        _dialect_ddl('create table if not exists realms ('
+                     ' id int not null auto_increment primary key,'
+                     ' name varchar(64) not null,'
+                     ' unique key realms_name (name))',
+                     'create table if not exists realms ('
+                     ' id integer primary key autoincrement,'
+                     ' name varchar(64) not null unique)'),
+        'create table if not exists aliases ('
+        ' alias varchar(64) not null primary key,'
+        ' realm_name varchar(64) not null)',
+        _dialect_ddl('create table if not exists transactions ('
+                     ' id int not null auto_increment primary key,'
+                     ' type varchar(16) not null,'
+                     ' author_id bigint not null,'
+                     ' booster_id bigint not null,'
+                     ' amount bigint not null,'
+                     ' comment varchar(255) null,'
+                     ' guild_id bigint not null,'
+                     ' realm_id int null,'
+                     ' date_added timestamp not null default current_timestamp)',
+                     'create table if not exists transactions ('
+                     ' id integer primary key autoincrement,'
+                     ' type varchar(16) not null,'
+                     ' author_id bigint not null,'
+                     ' booster_id bigint not null,'
+                     ' amount bigint not null,'
+                     ' comment varchar(255) null,'
+                     ' guild_id bigint not null,'
+                     ' realm_id int null,'
+                     ' date_added timestamp not null default current_timestamp)'),
+    ]),
+    (2, 'running balances', [
+        'create table if not exists balances ('
+        ' guild_id bigint not null,'
+        ' booster_id bigint not null,'
+        ' amount bigint not null default 0,'
+        ' primary key (guild_id, booster_id))',
+        _backfill_balances,
+    ]),
+    (3, 'payout cycles', [
+        _dialect_ddl('create table if not exists cycles ('
+                     ' id int not null auto_increment primary key,'
+                     ' guild_id bigint not null,'
+                     ' author_id bigint not null,'
+                     ' date_added timestamp not null default current_timestamp)',
+                     'create table if not exists cycles ('
+                     ' id integer primary key autoincrement,'
+                     ' guild_id bigint not null,'
+                     ' author_id bigint not null,'
+                     ' date_added timestamp not null default current_timestamp)'),
+        _add_column('transactions', 'cycle_id', 'int null'),
+    ]),
+    (4, 'indexes for db_handling access patterns', [
+        # list_transactions keyset pages
+        _create_index('transactions', 'transactions_booster_id', 'booster_id, id'),
+        # verify/rebuild balances aggregation
+        _create_index('transactions', 'transactions_guild_booster', 'guild_id, booster_id, amount'),
+        # get_realm_balance
+        _create_index('transactions', 'transactions_booster_realm', 'booster_id, realm_id, amount'),
+        # payout rows of a cycle
+        _create_index('transactions', 'transactions_cycle_id', 'cycle_id'),
+        # top and payout candidates
+        _create_index('balances', 'balances_guild_amount', 'guild_id, amount'),
+        _create_index('users', 'users_home_realm', 'home_realm'),
+    ]),
+    (5, 'archive of closed cycles', [
+        'create table if not exists transactions_archive ('
+        ' id int not null primary key,'
+        ' type varchar(16) not null,'
+        ' author_id bigint not null,'
+        ' booster_id bigint not null,'
+        ' amount bigint not null,'
+        ' comment varchar(255) null,'
+        ' guild_id bigint not null,'
+        ' realm_id int null,'
+        ' date_added timestamp not null,'
+        ' cycle_id int null,'
+        ' archive_cycle_id int not null)',
+        _create_index('transactions_archive', 'transactions_archive_booster_id', 'booster_id, id'),
+        _create_index('transactions_archive', 'transactions_archive_cycle', 'archive_cycle_id'),
+        _add_column('cycles', 'archived', 'int not null default 0'),
+        _create_index('cycles', 'cycles_guild_archived', 'guild_id, archived'),
+    ]),
+    (6, 'write-behind journal ids', [
+        _add_column('transactions', 'journal_id', 'char(36) null'),
+        _create_index('transactions', 'transactions_journal_id', 'journal_id', unique=True),
+        _add_column('transactions_archive', 'journal_id', 'char(36) null'),
+    ]),
+    (7, 'per-realm ledger', [
+        # realm holdings of guild, per-realm payout and carry forward rows
+        _create_index('transactions', 'transactions_guild_booster_realm', 'guild_id, booster_id, realm_id, amount'),
+    ]),
+    (8, 'boost uuid keyed ledger', [
+        _add_column('transactions', 'boost_uuid', 'char(36) null'),
+        _add_column('transactions_archive', 'boost_uuid', 'char(36) null'),
+        _backfill_boost_uuids,
+        # approvals of a boost are idempotent
+        _create_index('transactions', 'transactions_boost', 'boost_uuid, booster_id, type', unique=True),
+        _create_index('transactions_archive', 'transactions_archive_boost', 'boost_uuid'),
+    ]),
+    (9, 'journal ids of archived cycles', [
+        # journal replays and repeated approvals are checked against archived rows too
+        _create_index('transactions_archive', 'transactions_archive_journal_id', 'journal_id'),
+    ]),
+]
+
+# hot queries of db_handling with representative parameters, (name, sql, params), SQL is shared with db_handling so the check can't drift
+HOT_QUERIES = [
+    ('get_balance', db_handling.GET_BALANCE_SQL, (1, 1)),
+    ('list_transactions', db_handling.LIST_TRANSACTIONS_SQL.format(table='transactions'), (1, 26)),
+    ('list_transactions page', db_handling.LIST_TRANSACTIONS_PAGE_SQL.format(table='transactions'), (1, 1000, 26)),
+    ('list_transactions archived page', db_handling.LIST_TRANSACTIONS_PAGE_SQL.format(table='transactions_archive'), (1, 1000, 26)),
+    ('list_boost_transactions', db_handling.LIST_BOOST_TRANSACTIONS_SQL, ('', '')),
+    ('add_transactions_batch journal ids', db_handling.KNOWN_JOURNAL_IDS_SQL.format(placeholders='%s, %s'), ('', '', '', '')),
+    ('add_transactions_batch boost rows', db_handling.KNOWN_BOOST_ROWS_SQL, ('', '')),
+    ('execute_end_cycle preview', db_handling.PAYOUT_PREVIEW_SQL, (1,)),
+    ('execute_end_cycle payout', db_handling.PAYOUT_INSERT_SQL, (1, '', 1, 1, 1)),
+    ('execute_end_cycle balances', db_handling.PAYOUT_BALANCES_SQL, (1, 1, 1)),
+    ('execute_end_cycle payout rows', db_handling.CYCLE_PAYOUTS_SQL, (1,)),
+    ('archive_cycle last id', db_handling.ARCHIVE_LAST_ID_SQL, (1,)),
+    ('archive_cycle carry rows', db_handling.ARCHIVE_CARRY_SQL, (1, 1000)),
+    ('archive_cycle copy', db_handling.ARCHIVE_COPY_SQL, (1, 1, 1000)),
+    ('archive_cycle delete', db_handling.ARCHIVE_DELETE_SQL, (1, 1000)),
+    ('get_realm_balance', db_handling.GET_REALM_BALANCE_SQL, (1, 1)),
+    ('get_realm_balance of guild', db_handling.GET_GUILD_REALM_BALANCE_SQL, (1, 1, 1)),
+    ('list_realm_holdings', db_handling.LIST_REALM_HOLDINGS_SQL, (1,)),
+    ('list_realm_holdings of booster', db_handling.LIST_BOOSTER_REALM_HOLDINGS_SQL, (1, 1)),
+    ('stream_transactions cycle bounds', db_handling.CYCLE_LAST_ID_SQL, (1, 1)),
+    ('stream_transactions previous cycle', db_handling.CYCLE_PREVIOUS_LAST_ID_SQL, (1, 1)),
+    ('stream_transactions', db_handling.STREAM_TRANSACTIONS_SQL.format(table='transactions', conditions='guild_id=%s'), (1,)),
+    ('stream_transactions cycle', db_handling.STREAM_TRANSACTIONS_SQL.format(table='transactions', conditions='guild_id=%s and id > %s and id <= %s'), (1, 1, 1000)),
+    ('stream_transactions booster', db_handling.STREAM_TRANSACTIONS_SQL.format(table='transactions', conditions='guild_id=%s and booster_id=%s'), (1, 1)),
+    ('stream_transactions archived cycle', db_handling.STREAM_TRANSACTIONS_SQL.format(table='transactions_archive', conditions='guild_id=%s and archive_cycle_id=%s'), (1, 1)),
+]
+
+# --------------------------------------------------------------------------------------------------------------------------------------------
+
+def current_version():
+    with db_handling._db_cursor() as crs:
+        crs.execute('create table if not exists schema_version ('
+                    ' version int not null primary key,'
+                    ' description varchar(255) not null,'
+                    ' date_applied timestamp not null default current_timestamp)')
+        crs.execute('select max(version) from schema_version')
+        version, = crs.fetchone()
+
+    return version or 0
+
+
+def migrate():
+    """
+    Applies all migrations newer than the current schema version, returns list of applied versions.
+    """
+    applied = []
+    version = current_version()
+    for migration_version, description, steps in MIGRATIONS:
+        if migration_version <= version:
+            continue
+
+        LOG.info(f'Applying migration {migration_version}: {description}')
+        with db_handling._db_cursor() as crs:
+            for step in steps:
+                if callable(step):
+                    LOG.debug(step.__doc__ or step.__name__)
+                    step(crs)
+                else:
+                    LOG.debug(step)
+                    crs.execute(step)
+            crs.execute('insert into schema_version (`version`, `description`) values (%s, %s)', (migration_version, description))
+        applied.append(migration_version)
+
+    return applied
+
+# --------------------------------------------------------------------------------------------------------------------------------------------
+
+def check_query_plans():
+    """
+    Runs EXPLAIN for every hot query and raises SchemaError listing queries that scan a whole table.
+    """
+    failures = []
+    with db_handling._db_cursor(read_only=True) as crs:
+        for name, sql, params in HOT_QUERIES:
+            if db_handling.dialect() == 'sqlite':
+                crs.execute('explain query plan ' + sql, params)
+                # results of subqueries, scanning them doesn't touch a table
+                subqueries = set()
+                for row in crs.fetchall():
+                    # detail is e.g. "SCAN transactions" for a full scan and "SEARCH ... USING INDEX ..." otherwise
+                    detail = row[-1]
+                    if detail.startswith(('CO-ROUTINE ', 'MATERIALIZE ')):
+                        subqueries.add(detail.split(' ', 1)[1])
+                    elif detail.startswith('SCAN') and 'USING' not in detail and detail.split(' ', 1)[1] not in subqueries:
+                        failures.append(f'{name}: {detail}')
+            else:
+                crs.execute('explain ' + sql, params)
+                columns = [column[0] for column in crs.description]
+                for row in crs.fetchall():
+                    plan = dict(zip(columns, row))
+                    # <derivedN> is the result of a subquery
+                    if plan.get('type') == 'ALL' and not str(plan.get('table')).startswith('<'):
+                        failures.append(f'{name}: full scan of {plan.get("table")}')
+
+    if failures:
+        raise SchemaError('Full table scans in hot queries:\n' + '\n'.join(failures))
+
+# --------------------------------------------------------------------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)-23s %(name)-12s %(levelname)-8s %(message)s')
+    cmd = sys.argv[1] if len(sys.argv) > 1 else 'migrate'
+
+    if cmd == 'migrate':
+        LOG.info(f'Applied migrations: {migrate()}')
+    elif cmd == 'check':
+        check_query_plans()
+        LOG.info('All hot queries use indexes.')
+    else:
+        sys.exit(__doc__)
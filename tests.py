@@ -1,4 +1,32 @@
-from event_objects import Boost, Booster
+import asyncio
+import threading
+
+import pymysql
+import pytest
+
+from event_objects import Boost, Booster, BoostHandle
+import config
+import db_async
+import db_backends
+import db_handling
+import db_pool
+import export
+import globals
+import import_ledger
+import journal
+import leaderboard
+import migrations
+
+
+@pytest.fixture
+def sqlite_ledger(tmp_path):
+    """
+    Migrated SQLite ledger in tmp_path as the DB backend.
+    """
+    db_handling.set_backend(db_backends.SQLiteBackend(str(tmp_path / 'ledger.db')))
+    migrations.migrate()
+    yield tmp_path / 'ledger.db'
+    db_handling.set_backend(None)
 
 
 def test_is_this_valid_setup():
@@ -21,3 +49,396 @@ def test_is_this_valid_setup():
             boosters.append(all_boosters[test_idx // (7*7*7)])
         if not Boost(10, '', '', boosters, '', '', '', '').is_this_valid_setup():
             yield boosters
+
+
+def test_leaderboard_order_and_rank():
+    board = leaderboard.Leaderboard()
+    board.set(1, 300)
+    board.set(2, 500)
+    board.set(3, 100)
+    board.set(3, 700)
+    board.set(2, 0)
+
+    assert board.top(10) == [(700, 3), (300, 1)]
+    assert board.rank(1) == (2, 300)
+    assert board.rank(2) is None
+
+
+def test_boost_registry_message_index():
+    registry = globals.BoostRegistry()
+    boost = Boost(1, 10, '', '', '', [], '', '', '', 'no')
+    registry.add(BoostHandle(1, 2, 3), boost, None)
+    assert registry.uuid_by_msg_id(3) == boost.uuid
+
+    registry.add(BoostHandle(1, 2, 4), boost, None)
+    assert registry.uuid_by_msg_id(3) is None and registry.uuid_by_msg_id(4) == boost.uuid
+
+    registry.pop(boost.uuid)
+    assert not registry.has_msg_id(4) and boost.uuid not in registry and registry.pop(boost.uuid) is None
+
+
+def test_config_reload_swaps_snapshot(tmp_path):
+    path = tmp_path / 'config.json'
+    path.write_text('{"cmd_channels": ["bot"], "cuts": {"default": {"adv": 0.2, "mng": 0.05}}}')
+    old = config.CONFIG_PATH, config._SNAPSHOT, config._STAMP
+    config.CONFIG_PATH = str(path)
+    try:
+        config.reload()
+        cfg = config.snapshot()
+        assert 'bot' in cfg.cmd_channels and cfg.cuts['default'] == (0.2, 0.05)
+
+        path.write_text('{"cmd_channels": ["bot"], "cuts": ')
+        try:
+            config.reload_if_changed()
+            assert False, 'invalid config was loaded'
+        except config.ConfigError:
+            pass
+        # broken file is kept out and not retried until it changes again
+        assert config.snapshot() is cfg and not config.reload_if_changed()
+    finally:
+        config.CONFIG_PATH, config._SNAPSHOT, config._STAMP = old
+
+
+class _FakeConnection:
+    def __init__(self):
+        self.open = True
+        self.stale = False
+
+    def ping(self, reconnect=True):
+        if self.stale:
+            raise pymysql.err.OperationalError(2006, 'MySQL server has gone away')
+
+    def close(self):
+        self.open = False
+
+
+def test_pool_reuses_replaces_and_bounds_connections(monkeypatch):
+    monkeypatch.setattr(db_pool.ConnectionPool, '_new_connection', lambda self: _FakeConnection())
+    pool = db_pool.ConnectionPool({}, min_size=1, max_size=2, timeout=0.05, health_check_interval=-1)
+    first = pool.acquire()
+    second = pool.acquire()
+    with pytest.raises(db_pool.PoolTimeout):
+        pool.acquire()
+
+    pool.release(first)
+    assert pool.acquire() is first
+    first.stale = True
+    pool.release(first)
+    replacement = pool.acquire()
+    assert replacement is not first and not first.open
+
+    pool.release(second, broken=True)
+    pool.release(replacement)
+    stats = pool.stats()
+    assert (stats['size'], stats['in_use'], stats['idle'], stats['timeouts'], stats['reconnects']) == (1, 0, 1, 1, 1)
+
+
+def test_sqlite_hot_queries_use_indexes(sqlite_ledger):
+    migrations.check_query_plans()
+
+
+def test_sqlite_ledger_roundtrip(sqlite_ledger):
+    results = db_handling.add_transactions_batch([('add', 1, 'Kazzak', 500, None), ('deduct', 1, 'Kazzak', 100, None), ('add', 2, 'Draenor', 50, None)], 99, 7)
+    assert [error for _, _, error in results] == [None, None, None]
+    assert db_handling.get_balance(1, 7) == 'Total: 400'
+
+    cycle_id, payouts = db_handling.execute_end_cycle(7, 99)
+    assert payouts == [(1, 400), (2, 50)]
+    assert db_handling.get_balance(1, 7) == 'Total: 0'
+    assert db_handling.verify_balances(7) == []
+
+
+def test_sqlite_failed_commit_raises_database_error(sqlite_ledger):
+    with pytest.raises(db_handling.DatabaseError):
+        with db_handling._db_cursor() as crs:
+            # transaction ended early, commit on exit fails
+            crs.execute('commit')
+    with pytest.raises(ZeroDivisionError):
+        with db_handling._db_cursor():
+            1 / 0
+
+
+def test_sqlite_transactions_keyset_paging(sqlite_ledger):
+    db_handling.add_transactions_batch([('add', 1, 'Kazzak', amount, None) for amount in range(1, 6)] + [('add', 2, 'Kazzak', 100, None)], 99, 7)
+    amounts = []
+    before_id = None
+    while True:
+        page, before_id = db_handling.list_transactions(1, 2, before_id)
+        amounts.append([int(text.split('amount:')[1].split(',')[0]) for text, _ in page])
+        if before_id is None:
+            break
+    assert amounts == [[5, 4], [3, 2], [1]]
+
+
+def test_sqlite_realm_holdings(sqlite_ledger):
+    db_handling.add_transactions_batch([('add', 1, 'Kazzak', 500, None, 'Draenor'), ('add', 1, 'Kazzak', 200, None)], 99, 7)
+    db_handling.transfer_realm_gold(1, 99, 7, 100, 'Draenor', 'Kazzak')
+    assert db_handling.list_realm_holdings(7, 1) == [(1, 'Draenor', 400), (1, 'Kazzak', 300)]
+    assert db_handling.get_realm_balance('Kazzak', 1) == 300
+    assert db_handling.get_balance(1, 7) == 'Total: 700'
+
+    db_handling.execute_end_cycle(7, 99)
+    assert db_handling.list_realm_holdings(7) == []
+
+
+def test_sqlite_boost_approval_is_idempotent(sqlite_ledger):
+    boost_uuid = '12345678-1234-1234-1234-123456789abc'
+    entries = [('add', 1, 'Kazzak', 500, boost_uuid), ('add', 2, 'Kazzak', 500, boost_uuid)]
+    assert [error for _, _, error in db_handling.add_transactions_batch(entries, 99, 7, boost_uuid=boost_uuid)] == [None, None]
+    assert [error for _, _, error in db_handling.add_transactions_batch(entries, 98, 7, boost_uuid=boost_uuid)] == ['Already processed'] * 2
+    assert db_handling.get_balance(1, 7) == 'Total: 500'
+    assert [booster_id for booster_id, *_ in db_handling.list_boost_transactions(boost_uuid)] == [1, 2]
+
+
+def test_sqlite_approval_after_archive_is_idempotent(sqlite_ledger):
+    boost_uuid = '12345678-1234-1234-1234-123456789abc'
+    entries = [('add', 1, 'Kazzak', 500, boost_uuid)]
+    db_handling.add_transactions_batch(entries, 99, 7, boost_uuid=boost_uuid)
+    db_handling.add_transactions_batch([('add', 2, 'Kazzak', 100, None)], 99, 7, journal_ids=['journal-1'])
+    db_handling.execute_end_cycle(7, 99)
+    db_handling.archive_cycle(7, 99)
+
+    # stale approval message and journal replay after the rows were archived
+    assert [error for _, _, error in db_handling.add_transactions_batch(entries, 99, 7, boost_uuid=boost_uuid)] == ['Already processed']
+    assert [error for _, _, error in db_handling.add_transactions_batch([('add', 2, 'Kazzak', 100, None)], 99, 7, journal_ids=['journal-1'])] == ['Already processed']
+    assert db_handling.get_balance(1, 7) == 'Total: 0' and db_handling.get_balance(2, 7) == 'Total: 0'
+
+
+def test_sqlite_realm_added_outside_cache(sqlite_ledger):
+    db_handling.load_realm_cache()
+    # e.g. by import tool in another process
+    with db_handling._db_cursor() as crs:
+        crs.execute('insert into realms (`name`) values (%s)', 'Draenor')
+
+    assert [error for _, _, error in db_handling.add_transactions_batch([('add', 1, 'Kazzak', 100, None, 'Draenor')], 99, 7)] == [None]
+    assert db_handling.get_realm_balance('Draenor', 1) == 100
+
+    # gold booked on a realm the other process added, this process never resolved it
+    with db_handling._db_cursor() as crs:
+        crs.execute('insert into realms (`name`) values (%s)', 'Silvermoon')
+        crs.execute('insert into transactions (`type`, `author_id`, `booster_id`, `amount`, `guild_id`, `realm_id`) select %s, 99, 1, 40, 7, id from realms where name=%s', ('add', 'Silvermoon'))
+    assert db_handling.get_realm_balance('Silvermoon', 1) == 40
+
+
+def test_sqlite_concurrent_writers(sqlite_ledger):
+    errors = []
+
+    def write(worker):
+        for idx in range(50):
+            try:
+                db_handling.add_transactions_batch([('add', worker, 'Kazzak', 10, None)], 99, 7, journal_ids=[f'{worker}-{idx}'])
+            except db_handling.DatabaseError as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=write, args=(worker,)) for worker in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert db_handling.get_balance(3, 7) == 'Total: 500'
+
+
+def test_sqlite_archive_cycle_carries_open_balances(sqlite_ledger):
+    # booster 2 is in debt, payout skips it and archive has to carry its balance forward
+    db_handling.add_transactions_batch([('add', 1, 'Kazzak', 500, None), ('deduct', 2, 'Kazzak', 300, None)], 99, 7)
+    cycle_id, _ = db_handling.execute_end_cycle(7, 99)
+    db_handling.add_transactions_batch([('add', 1, 'Kazzak', 50, None)], 99, 7)
+
+    assert db_handling.archive_cycle(7, 99) == (cycle_id, 3, 1)
+    assert db_handling.get_balance(1, 7) == 'Total: 50'
+    assert db_handling.get_balance(2, 7) == 'Total: -300'
+    assert db_handling.verify_balances(7) == []
+    page, _ = db_handling.list_transactions(1, 10, archived=True)
+    assert len(page) == 2
+    with pytest.raises(db_handling.DatabaseError):
+        db_handling.archive_cycle(7, 99, cycle_id)
+
+
+def test_journal_keeps_boost_payout_in_one_batch(sqlite_ledger, tmp_path):
+    ledger_journal = journal.Journal(str(tmp_path / 'journal.jsonl'), batch_size=2)
+    boost_uuid = '12345678-1234-1234-1234-123456789abc'
+    # advertiser who is also booster has two lines in payout of a boost
+    entries = [('add', 1, 'Kazzak', 100, boost_uuid), ('add', 2, 'Kazzak', 300, boost_uuid), ('add', 1, 'Kazzak', 100, boost_uuid)]
+    ledger_journal.append(entries, 99, 7, boost_uuid)
+    # approved again by the same author
+    ledger_journal.append(entries, 99, 7, boost_uuid)
+
+    assert ledger_journal.flush() == 6
+    assert db_handling.get_balance(1, 7) == 'Total: 200'
+    assert db_handling.get_balance(2, 7) == 'Total: 300'
+
+
+def test_journal_replay_after_crash(sqlite_ledger, tmp_path):
+    path = str(tmp_path / 'journal.jsonl')
+    ledger_journal = journal.Journal(path)
+    ledger_journal.append([('add', 1, 'Kazzak', 100, None), ('deduct', 1, 'Kazzak', 30, None)], 99, 7)
+    assert ledger_journal.flush() == 2
+
+    # crash after DB commit and before offset was written
+    ledger_journal._write_offset(0)
+    restarted = journal.Journal(path)
+    assert len(restarted.pending()) == 2
+    assert restarted.flush() == 2
+    assert db_handling.get_balance(1, 7) == 'Total: 70'
+    assert restarted.pending() == []
+
+
+def test_journal_compaction(sqlite_ledger, tmp_path):
+    path = tmp_path / 'journal.jsonl'
+    ledger_journal = journal.Journal(str(path), compact_size=1)
+    ledger_journal.append([('add', 1, 'Kazzak', 100, None)], 99, 7)
+    assert ledger_journal.flush() == 1
+    assert path.stat().st_size == 0 and ledger_journal._read_offset() == 0
+
+    ledger_journal.append([('add', 1, 'Kazzak', 50, None)], 99, 7)
+    with open(path, 'a') as f:
+        # torn record of a crashed append
+        f.write('{"journal_id": ')
+    assert ledger_journal.flush() == 1
+    # file holding unflushed bytes is never truncated
+    assert path.stat().st_size > ledger_journal._read_offset() > 0
+    assert db_handling.get_balance(1, 7) == 'Total: 150'
+
+
+def test_journal_cuts_torn_line_on_restart(sqlite_ledger, tmp_path):
+    path = tmp_path / 'journal.jsonl'
+    journal.Journal(str(path)).append([('add', 1, 'Kazzak', 100, None)], 99, 7)
+    with open(path, 'a') as f:
+        # corrupt whole line and torn record of a crashed append
+        f.write('not a record\n{"journal_id": ')
+
+    restarted = journal.Journal(str(path))
+    restarted.append([('add', 1, 'Kazzak', 50, None)], 99, 7)
+    assert restarted.flush() == 2
+    assert db_handling.get_balance(1, 7) == 'Total: 150'
+    assert restarted.dead_count() == 1 and restarted.pending() == []
+    assert restarted.flush() == 0 and restarted.dead_count() == 1
+
+
+def test_journal_dead_letters_failing_batch(sqlite_ledger, tmp_path, monkeypatch):
+    ledger_journal = journal.Journal(str(tmp_path / 'journal.jsonl'), max_attempts=2)
+    ledger_journal.append([('add', 13, 'Kazzak', 100, None)], 99, 7)
+    ledger_journal.append([('add', 2, 'Kazzak', 100, None)], 98, 7)
+    add_transactions_batch = db_handling.add_transactions_batch
+
+    def failing_batch(entries, *args, **kwargs):
+        if entries[0][1] == 13:
+            raise db_handling.DatabaseError('poison')
+        return add_transactions_batch(entries, *args, **kwargs)
+
+    monkeypatch.setattr(db_handling, 'add_transactions_batch', failing_batch)
+    with pytest.raises(db_handling.DatabaseError):
+        ledger_journal.flush()
+    # second failure while DB answers moves the batch aside and unblocks later records
+    assert ledger_journal.flush() == 2
+    assert db_handling.get_balance(2, 7) == 'Total: 100'
+    assert ledger_journal.dead_count() == 1 and ledger_journal.dead_lettered == 1
+
+    monkeypatch.setattr(db_handling, 'add_transactions_batch', add_transactions_batch)
+    assert ledger_journal.requeue_dead() == 1
+    assert ledger_journal.flush() == 1
+    assert db_handling.get_balance(13, 7) == 'Total: 100' and ledger_journal.dead_count() == 0
+
+
+def test_sqlite_payout_of_realm_in_deficit(sqlite_ledger):
+    db_handling.add_transactions_batch([('add', 1, 'Kazzak', 500, None, 'Draenor'), ('deduct', 1, 'Kazzak', 100, None)], 99, 7)
+    # preview lists the rows payout writes
+    assert db_handling.execute_end_cycle(7, 99, dry_run=True) == (None, [(1, 'Draenor', -500), (1, 'Kazzak', 100)])
+    cycle_id, payouts = db_handling.execute_end_cycle(7, 99)
+    assert payouts == [(1, 400)]
+
+    rows = []
+    db_handling.stream_transactions(rows.append, 7, cycle_id=cycle_id)
+    assert sorted(amount for _, type, _, _, amount, *_ in rows if type == 'payout') == [-500, 100]
+    assert db_handling.list_realm_holdings(7) == []
+
+
+def test_sqlite_stream_select_row_cap(sqlite_ledger):
+    db_handling.add_transactions_batch([('add', booster_id, 'Kazzak', 100, None) for booster_id in range(5)], 99, 7)
+    rows = []
+    # joins with duplicate column names are passed to DB as they are
+    assert db_handling.stream_select('select t.id, b.booster_id from transactions as t join balances as b on (t.booster_id = b.booster_id)', rows.append, 3, 10.0) == (3, True)
+    assert len(rows) == 3
+
+
+def test_sqlite_export_cycle(sqlite_ledger, tmp_path):
+    db_handling.add_transactions_batch([('add', 1, 'Kazzak', 500, None)], 99, 7)
+    first_cycle, _ = db_handling.execute_end_cycle(7, 99)
+    db_handling.add_transactions_batch([('add', 1, 'Kazzak', 200, None), ('add', 2, 'Kazzak', 300, None)], 99, 7)
+    second_cycle, _ = db_handling.execute_end_cycle(7, 99)
+
+    rows = []
+    db_handling.stream_transactions(rows.append, 7, cycle_id=second_cycle)
+    assert [(type, booster_id, amount) for _, type, _, booster_id, amount, *_ in rows] == [('add', 1, 200), ('add', 2, 300), ('payout', 1, -200), ('payout', 2, -300)]
+
+    db_handling.archive_cycle(7, 99, first_cycle)
+    assert export.export_transactions(str(tmp_path / 'first.csv.gz'), 7, cycle_id=first_cycle, archived=True) == 2
+
+    with pytest.raises(ValueError):
+        export.export_transactions(str(tmp_path / 'bad.csv.gz'), 7, since='not a day')
+    assert not (tmp_path / 'bad.csv.gz').exists()
+
+
+def test_import_resumes_after_failed_chunk(sqlite_ledger, tmp_path, monkeypatch):
+    path = tmp_path / 'ledger.csv'
+    path.write_text('type,booster,amount,home_realm,comment,date\n'
+                    'add,<@1>,20k,Kazzak,old,2021-03-04\n'
+                    'add,2,1500,Kazzak,,2021-03-05 18:30:00\n'
+                    'add,3,ten,Kazzak,,\n'
+                    'deduct,1,5k,Kazzak,,\n'
+                    'add,2,500,Kazzak,,yesterday\n')
+
+    add_transactions_batch = db_handling.add_transactions_batch
+    def fail_second_chunk(entries, *args, **kwargs):
+        if entries[0][1] == 1 and entries[0][0] == 'deduct':
+            raise db_handling.DatabaseError('connection lost')
+        return add_transactions_batch(entries, *args, **kwargs)
+    monkeypatch.setattr(db_handling, 'add_transactions_batch', fail_second_chunk)
+    with pytest.raises(db_handling.DatabaseError):
+        import_ledger.import_transactions(str(path), 7, 99, chunk_size=2)
+
+    monkeypatch.setattr(db_handling, 'add_transactions_batch', add_transactions_batch)
+    # first chunk is skipped by the checkpoint, rows with bad amount and date are rejected again
+    assert import_ledger.import_transactions(str(path), 7, 99, chunk_size=2) == (1, 2)
+    assert db_handling.get_balance(1, 7) == 'Total: 15000'
+    assert db_handling.get_balance(2, 7) == 'Total: 1500'
+    with db_handling._db_cursor(read_only=True) as crs:
+        crs.execute('select booster_id, date_added from transactions order by id')
+        dates = [(booster_id, str(date_added)) for booster_id, date_added in crs]
+    assert dates[:2] == [(1, '2021-03-04 00:00:00'), (2, '2021-03-05 18:30:00')]
+
+    # rejects of the failed run after its checkpoint are not kept twice
+    rejects_path = tmp_path / 'ledger.csv.rejects.csv'
+    assert len(rejects_path.read_text().splitlines()) == 2
+
+    # rerun from scratch, only the first chunk looks up journal ids and the later one is skipped after its conflict
+    (tmp_path / 'ledger.csv.checkpoint').unlink()
+    assert import_ledger.import_transactions(str(path), 7, 99, chunk_size=2) == (0, 2)
+    assert db_handling.get_balance(1, 7) == 'Total: 15000'
+    assert len(rejects_path.read_text().splitlines()) == 2
+
+
+def test_read_cache_invalidated_by_writes(sqlite_ledger):
+    async def scenario():
+        calls = []
+        def read(value):
+            calls.append(value)
+            return value
+
+        cache = db_async.ReadCache(60.0, 10)
+        # concurrent identical reads share one call
+        assert await asyncio.gather(cache.get('k', [('booster', 1)], read, 'a'), cache.get('k', [('booster', 1)], read, 'a')) == ['a', 'a']
+        assert await cache.get('k', [('booster', 1)], read, 'b') == 'a'
+        cache.invalidate(('booster', 2))
+        assert await cache.get('k', [('booster', 1)], read, 'b') == 'a'
+        cache.invalidate(('booster', 1))
+        assert await cache.get('k', [('booster', 1)], read, 'b') == 'b'
+        assert calls == ['a', 'b']
+
+        assert await db_async.get_balance(1, 7) == 'Total: 0'
+        await db_async.add_transactions_batch([('add', 1, 'Kazzak', 100, None)], 99, 7)
+        assert await db_async.get_balance(1, 7) == 'Total: 100'
+
+    asyncio.run(scenario())